@@ -4,14 +4,18 @@ from discord import app_commands, ui
 import aiosqlite
 import datetime
 import random
+import time
 import uuid
 import asyncio
+import bisect
 import logging
 import traceback
 import math
 import contextlib
 import os
+import io
 import glob
+import itertools
 from typing import Optional, List, Dict
 from dotenv import load_dotenv
 from logging.handlers import RotatingFileHandler
@@ -70,12 +74,22 @@ class ConfigManager:
         self.vc_reward_per_min: int = 10
         self.role_wages: Dict[int, int] = {}       
         self.admin_roles: Dict[int, str] = {}      
+        # server_config の写し（ログ先・面接設定など、設定コマンドでしか変わらない値を引く用）
+        # ※ jackpot_pool のようにSQLで直接増減する値はここから読まないこと
+        self._cache: Dict[str, str] = {}
+        self.interview_exclude_roles: frozenset = frozenset()
+        # ログ先などの設定キー → 解決済みチャンネル（設定変更・チャンネル削除で破棄）
+        self._channel_cache: Dict[str, discord.abc.Messageable] = {}
+        # 読み取り→変更→書き込みを行う設定更新（除外ロールの追加・削除など）を1つずつ通す
+        self.write_lock = asyncio.Lock()
 
     async def reload(self):
         async with self.bot.get_db() as db:
-            async with db.execute("SELECT value FROM server_config WHERE key = 'vc_reward'") as cursor:
-                row = await cursor.fetchone()
-                if row: self.vc_reward_per_min = int(row['value'])
+            async with db.execute("SELECT key, value FROM server_config") as cursor:
+                self._cache = {r['key']: r['value'] async for r in cursor}
+            self._channel_cache.clear()
+            if 'vc_reward' in self._cache: self.vc_reward_per_min = int(self._cache['vc_reward'])
+            self._parse_exclude_roles()
             
             async with db.execute("SELECT role_id, amount FROM role_wages") as cursor:
                 rows = await cursor.fetchall()
@@ -86,6 +100,57 @@ class ConfigManager:
                 self.admin_roles = {r['role_id']: r['perm_level'] for r in rows}
         logger.info("Configuration and Permissions reloaded.")
 
+    def get_eval_routes(self) -> Dict[int, dict]:
+        """branch_{枠}_{role|emoji|desc} をまとめて {枠: {'role_id', 'emoji', 'desc'}} にする（ロール未設定の枠は除く）"""
+        slots: Dict[int, dict] = {}
+        for key, value in self._cache.items():
+            if not key.startswith('branch_'): continue
+            _, slot, field = key.split('_', 2)
+            slots.setdefault(int(slot), {})[field] = value
+        return {
+            slot: {'role_id': int(d['role']), 'emoji': d.get('emoji'), 'desc': d.get('desc')}
+            for slot, d in sorted(slots.items()) if 'role' in d
+        }
+
+    def _parse_exclude_roles(self):
+        value = self._cache.get('interview_exclude_roles')
+        self.interview_exclude_roles = frozenset(int(x) for x in value.split(',')) if value else frozenset()
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        return self._cache.get(key, default)
+
+    def get_int(self, key: str, default: Optional[int] = None) -> Optional[int]:
+        value = self._cache.get(key)
+        return int(value) if value else default
+
+    async def set(self, key: str, value: str):
+        await self.set_many({key: value})
+
+    async def set_many(self, values: Dict[str, str]):
+        """複数キーを1回の executemany・1コミットで書き込む"""
+        async with self.bot.get_db() as db:
+            await db.executemany("INSERT OR REPLACE INTO server_config (key, value) VALUES (?, ?)", values.items())
+            await db.commit()
+        self._cache.update(values)
+        for key in values:
+            self._channel_cache.pop(key, None)
+        if 'interview_exclude_roles' in values:
+            self._parse_exclude_roles()
+
+    def get_channel(self, key: str) -> Optional[discord.abc.Messageable]:
+        """設定キーが指すチャンネルを返す。一度解決したものは使い回す"""
+        channel = self._channel_cache.get(key)
+        if channel is None:
+            channel_id = self.get_int(key)
+            channel = self.bot.get_channel(channel_id) if channel_id else None
+            if channel is not None:
+                self._channel_cache[key] = channel
+        return channel
+
+    def forget_channel(self, channel_id: int):
+        for key in [k for k, ch in self._channel_cache.items() if ch.id == channel_id]:
+            del self._channel_cache[key]
+
 def has_permission(required_level: str):
     async def predicate(interaction: discord.Interaction) -> bool:
         if await interaction.client.is_owner(interaction.user):
@@ -114,6 +179,16 @@ def has_permission(required_level: str):
         raise app_commands.AppCommandError(f"この操作には '{required_level}' 以上の権限が必要です。")
     return app_commands.check(predicate)
 
+# 取引ログの month_tag（"%Y-%m"）。月の切り替わりは分単位で拾えば十分なので、1分間は同じ文字列を返す
+_MONTH_TAG_CACHE = {"minute": -1, "tag": ""}
+
+def current_month_tag() -> str:
+    minute = int(time.time() // 60)
+    if minute != _MONTH_TAG_CACHE["minute"]:
+        _MONTH_TAG_CACHE["minute"] = minute
+        _MONTH_TAG_CACHE["tag"] = datetime.datetime.now().strftime("%Y-%m")
+    return _MONTH_TAG_CACHE["tag"]
+
 class BankDatabase:
     def __init__(self, db_path="stella_bank_v1.db"):
         self.db_path = db_path
@@ -209,6 +284,10 @@ class BankDatabase:
 
         # 4. インデックス
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_trans_receiver ON transactions (receiver_id, created_at DESC)")
+        # 取引履歴 (sender_id = ? OR receiver_id = ?) を両側インデックスで引けるようにする
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_trans_sender ON transactions (sender_id, created_at DESC)")
+        # 経済レポートの「直近24時間」集計を全件走査ではなく範囲検索にする
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_trans_created ON transactions (created_at)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_temp_vc_expire ON temp_vcs (expire_at)")
         
 
@@ -234,6 +313,16 @@ class BankDatabase:
             )
         """)
 
+        # 買い切り商品の購入記録（同じロールの二重購入・二重引き落としを主キーで防ぐ）
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS shop_permanent_purchases (
+                user_id INTEGER,
+                role_id INTEGER,
+                purchased_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, role_id)
+            )
+        """)
+
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS ticket_inventory (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -246,6 +335,14 @@ class BankDatabase:
                 used_by INTEGER
             )
         """)
+        # 商品一覧は shop_id で引く（主キーは role_id が先頭なので効かない）
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_shop_items_shop ON shop_items (shop_id, role_id)")
+        # 購入時の所持上限チェック（未使用チケットの枚数）用
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_ticket_unused ON ticket_inventory (user_id, item_key) WHERE used_at IS NULL")
+        # 管理者の未使用チケット一覧（ショップ別・購入順）用
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_ticket_shop_unused ON ticket_inventory (shop_id, purchased_at) WHERE used_at IS NULL")
+        # 1時間ごとの期限切れサブスク抽出・削除を範囲検索にする
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_sub_expiry ON shop_subscriptions (expiry_date)")
 
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS lottery_tickets (
@@ -284,7 +381,7 @@ class BankDatabase:
                 user_id INTEGER,
                 issuer_id INTEGER,
                 amount INTEGER,
-                avg_cost REAL,
+                total_cost INTEGER DEFAULT 0,
                 PRIMARY KEY (user_id, issuer_id)
             )
         """)
@@ -524,7 +621,7 @@ class PlanSelect(discord.ui.Select):
                     f"❌ 残高不足です。\n必要: {price:,} Stell / 所持: {current_bal:,} Stell", ephemeral=True
                 )
 
-            month_tag = datetime.datetime.now().strftime("%Y-%m")
+            month_tag = current_month_tag()
             await db.execute("UPDATE accounts SET balance = balance - ? WHERE user_id = ?", (price, user.id))
             await db.execute(
                 "INSERT INTO transactions (sender_id, receiver_id, amount, type, description, month_tag) VALUES (?, 0, ?, 'VC_CREATE', ?, ?)",
@@ -617,11 +714,10 @@ class PublicPlanSelect(discord.ui.Select):
                 )
 
             # 除外ロールを取得
-            async with db.execute("SELECT value FROM server_config WHERE key = 'public_vc_exclude_roles'") as c:
-                row = await c.fetchone()
-            exclude_ids = [int(x) for x in row['value'].split(',') if x] if row and row['value'] else []
+            value = bot.config.get('public_vc_exclude_roles')
+            exclude_ids = [int(x) for x in value.split(',') if x] if value else []
 
-            month_tag = datetime.datetime.now().strftime("%Y-%m")
+            month_tag = current_month_tag()
             await db.execute("UPDATE accounts SET balance = balance - ? WHERE user_id = ?", (price, user.id))
             await db.execute(
                 "INSERT INTO transactions (sender_id, receiver_id, amount, type, description, month_tag) VALUES (?, 0, ?, 'PUBLIC_VC_CREATE', ?, ?)",
@@ -681,17 +777,12 @@ class PublicVCPanel(discord.ui.View):
 
     @discord.ui.button(label="公開VCを作成する", style=discord.ButtonStyle.primary, custom_id="create_public_vc_btn", emoji="🔓")
     async def create_vc_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        bot = interaction.client
-        prices = {}
-        async with bot.get_db() as db:
-            async with db.execute("SELECT key, value FROM server_config WHERE key IN ('public_vc_price_6', 'public_vc_price_12', 'public_vc_price_24')") as cursor:
-                rows = await cursor.fetchall()
-                for row in rows:
-                    prices[row['key'].replace('public_vc_price_', '')] = int(row['value'])
-
-        if '6'  not in prices: prices['6']  = 10000
-        if '12' not in prices: prices['12'] = 30000
-        if '24' not in prices: prices['24'] = 50000
+        config = interaction.client.config
+        prices = {
+            '6':  config.get_int('public_vc_price_6',  10000),
+            '12': config.get_int('public_vc_price_12', 30000),
+            '24': config.get_int('public_vc_price_24', 50000),
+        }
 
         view = discord.ui.View()
         view.add_item(PublicPlanSelect(prices))
@@ -703,17 +794,12 @@ class VCPanel(discord.ui.View):
 
     @discord.ui.button(label="一時VCを作成する", style=discord.ButtonStyle.success, custom_id="create_temp_vc_btn", emoji="🔒")
     async def create_vc_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        bot = interaction.client
-        prices = {}
-        async with bot.get_db() as db:
-            async with db.execute("SELECT key, value FROM server_config WHERE key IN ('vc_price_6', 'vc_price_12', 'vc_price_24')") as cursor:
-                rows = await cursor.fetchall()
-                for row in rows:
-                    prices[row['key'].replace('vc_price_', '')] = int(row['value'])
-
-        if '6'  not in prices: prices['6']  = 30000
-        if '12' not in prices: prices['12'] = 50000
-        if '24' not in prices: prices['24'] = 80000
+        config = interaction.client.config
+        prices = {
+            '6':  config.get_int('vc_price_6',  30000),
+            '12': config.get_int('vc_price_12', 50000),
+            '24': config.get_int('vc_price_24', 80000),
+        }
 
         view = discord.ui.View()
         view.add_item(PlanSelect(prices))
@@ -796,11 +882,11 @@ class PrivateVCManager(commands.Cog):
         else:
             description = description.replace("\\n", "\n")
 
-        async with self.bot.get_db() as db:
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES ('vc_price_6', ?)",  (str(price_6h),))
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES ('vc_price_12', ?)", (str(price_12h),))
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES ('vc_price_24', ?)", (str(price_24h),))
-            await db.commit()
+        await self.bot.config.set_many({
+            'vc_price_6':  str(price_6h),
+            'vc_price_12': str(price_12h),
+            'vc_price_24': str(price_24h),
+        })
 
         embed = discord.Embed(title=title, description=description, color=Color.DARK)
         embed.set_footer(text=f"Last Updated: {datetime.datetime.now().strftime('%Y/%m/%d %H:%M')}")
@@ -820,10 +906,9 @@ class PrivateVCManager(commands.Cog):
     async def config_public_vc_exclude(self, interaction: discord.Interaction, action: str, role: Optional[discord.Role] = None):
         await interaction.response.defer(ephemeral=True)
 
-        async with self.bot.get_db() as db:
-            async with db.execute("SELECT value FROM server_config WHERE key = 'public_vc_exclude_roles'") as c:
-                row = await c.fetchone()
-            current = row['value'].split(',') if row and row['value'] else []
+        config = self.bot.config
+        value = config.get('public_vc_exclude_roles')
+        current = value.split(',') if value else []
 
         if action == "list":
             if not current:
@@ -835,20 +920,21 @@ class PrivateVCManager(commands.Cog):
         if not role:
             return await interaction.followup.send("❌ ロールを指定してください。", ephemeral=True)
 
-        if action == "add":
-            if str(role.id) in current:
-                return await interaction.followup.send(f"⚠️ {role.mention} は既に登録されています。", ephemeral=True)
-            current.append(str(role.id))
-            msg = f"✅ {role.mention} を除外ロールに追加しました。"
-        else:
-            if str(role.id) not in current:
-                return await interaction.followup.send(f"⚠️ {role.mention} は登録されていません。", ephemeral=True)
-            current.remove(str(role.id))
-            msg = f"🗑️ {role.mention} を除外ロールから削除しました。"
-
-        async with self.bot.get_db() as db:
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES ('public_vc_exclude_roles', ?)", (','.join(current),))
-            await db.commit()
+        # 読み取り→変更→書き込みの間に別の更新が挟まらないよう、キャッシュから読み直してロック内で行う
+        async with config.write_lock:
+            value = config.get('public_vc_exclude_roles')
+            current = value.split(',') if value else []
+            if action == "add":
+                if str(role.id) in current:
+                    return await interaction.followup.send(f"⚠️ {role.mention} は既に登録されています。", ephemeral=True)
+                current.append(str(role.id))
+                msg = f"✅ {role.mention} を除外ロールに追加しました。"
+            else:
+                if str(role.id) not in current:
+                    return await interaction.followup.send(f"⚠️ {role.mention} は登録されていません。", ephemeral=True)
+                current.remove(str(role.id))
+                msg = f"🗑️ {role.mention} を除外ロールから削除しました。"
+            await config.set('public_vc_exclude_roles', ','.join(current))
 
         await interaction.followup.send(msg, ephemeral=True)
 
@@ -886,11 +972,11 @@ class PrivateVCManager(commands.Cog):
         else:
             description = description.replace("\\n", "\n")
 
-        async with self.bot.get_db() as db:
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES ('public_vc_price_6', ?)",  (str(price_6h),))
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES ('public_vc_price_12', ?)", (str(price_12h),))
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES ('public_vc_price_24', ?)", (str(price_24h),))
-            await db.commit()
+        await self.bot.config.set_many({
+            'public_vc_price_6':  str(price_6h),
+            'public_vc_price_12': str(price_12h),
+            'public_vc_price_24': str(price_24h),
+        })
 
         embed = discord.Embed(title=title, description=description, color=Color.DARK)
         embed.set_footer(text=f"Last Updated: {datetime.datetime.now().strftime('%Y/%m/%d %H:%M')}")
@@ -928,7 +1014,7 @@ class TransferConfirmView(discord.ui.View):
 
         await interaction.response.defer()
         
-        month_tag = datetime.datetime.now().strftime("%Y-%m")
+        month_tag = current_month_tag()
         sender_new_bal = 0
         receiver_new_bal = 0
 
@@ -977,22 +1063,16 @@ class TransferConfirmView(discord.ui.View):
                 except:
                     pass
 
-                log_ch_id = None
-                async with db.execute("SELECT value FROM server_config WHERE key = 'currency_log_id'") as c:
-                    row = await c.fetchone()
-                    if row: log_ch_id = int(row['value'])
-                
-                if log_ch_id:
-                    channel = self.bot.get_channel(log_ch_id)
-                    if channel:
-                        now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        log_embed = discord.Embed(title="💸 送金ログ", color=Color.STELL)
-                        log_embed.description = f"{self.sender.mention} ➔ {self.receiver.mention}"
-                        log_embed.add_field(name="金額", value=f"**{self.amount:,} Stell**", inline=True)
-                        log_embed.add_field(name="備考", value=self.msg, inline=True)
-                        log_embed.add_field(name="処理後残高", value=f"送: {sender_new_bal:,} Stell\n受: {receiver_new_bal:,} Stell", inline=False)
-                        log_embed.set_footer(text=f"Time: {now_str}")
-                        await channel.send(embed=log_embed)
+                channel = self.bot.config.get_channel('currency_log_id')
+                if channel:
+                    now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    log_embed = discord.Embed(title="💸 送金ログ", color=Color.STELL)
+                    log_embed.description = f"{self.sender.mention} ➔ {self.receiver.mention}"
+                    log_embed.add_field(name="金額", value=f"**{self.amount:,} Stell**", inline=True)
+                    log_embed.add_field(name="備考", value=self.msg, inline=True)
+                    log_embed.add_field(name="処理後残高", value=f"送: {sender_new_bal:,} Stell\n受: {receiver_new_bal:,} Stell", inline=False)
+                    log_embed.set_footer(text=f"Time: {now_str}")
+                    await channel.send(embed=log_embed)
 
             except Exception as e:
                 await db.rollback()
@@ -1010,6 +1090,10 @@ class TransferConfirmView(discord.ui.View):
         await interaction.response.edit_message(content="❌ 送金をキャンセルしました。", embed=None, view=None)
 
 # ── Cog: Economy (残高・送金・ランキング・資金操作) ──
+# ゴミ拾いの出目（累積%）: 釈迦0.1 / 涅槃1 / 煩悩8 / 財布5 / お賽銭15 / 通常76.9
+GOMI_OUTCOMES    = ("shaka", "nirvana", "bonnou", "wallet", "saisen", "normal")
+GOMI_CUM_WEIGHTS = (0.1, 1.1, 9.1, 14.1, 29.1, 100)
+
 class Economy(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -1089,8 +1173,8 @@ class Economy(commands.Cog):
         user_id = interaction.user.id
         today   = datetime.datetime.now().strftime("%Y-%m-%d")
 
-        bj_limit        = await _cfg(self.bot, "slot_daily_limit")
-        chinchiro_limit = await _cfg(self.bot, "chinchiro_daily_limit")
+        bj_limit        = _cfg(self.bot, "slot_daily_limit")
+        chinchiro_limit = _cfg(self.bot, "chinchiro_daily_limit")
 
         async with self.bot.get_db() as db:
             async with db.execute(
@@ -1168,28 +1252,28 @@ class Economy(commands.Cog):
                 )
 
             # イースターエッグ抽選
-            roll = random.random() * 100
-            if roll < 0.1:
+            outcome = random.choices(GOMI_OUTCOMES, cum_weights=GOMI_CUM_WEIGHTS)[0]
+            if outcome == "shaka":
                 # 釈迦から特別（0.1%）
                 amount  = 10000
                 gain    = amount
                 message = "✨ 釈迦「**特別やで**」\n**10,000 Stell** もらった！"
-            elif roll < 1.1:
+            elif outcome == "nirvana":
                 # 涅槃（1%）
                 amount  = 0
                 gain    = 0
                 message = "🪷 涅槃に達した…お金への執着を手放した。\n**(+0 Stell)**"
-            elif roll < 9.1:
-                # 煩悩（8%）
-                amount  = -random.randint(100, 300)
+            elif outcome == "bonnou":
+                # 煩悩（8%）残高0なら失うものがないので乱数を引かない
+                amount  = -random.randint(100, 300) if bal > 0 else 0
                 gain    = max(amount, -bal)  # マイナスにならないよう調整
                 message = f"😩 煩悩を拾ってしまった…108の苦しみ。\n**{gain:,} Stell**"
-            elif roll < 14.1:
+            elif outcome == "wallet":
                 # お賽銭（5%）
                 amount  = random.randint(2000, 5000)
                 gain    = amount
                 message = f"👛 釈迦の財布を発見！功徳が積まれた！\n**+{gain:,} Stell**"
-            elif roll < 29.1:
+            elif outcome == "saisen":
                 # お賽銭（15%）
                 amount  = random.randint(50, 200)
                 gain    = amount
@@ -1209,7 +1293,7 @@ class Economy(commands.Cog):
                         total_earned = total_earned + MAX(0, ?)
                 """, (user_id, gain, max(gain, 0), gain, max(gain, 0)))
 
-                month_tag = datetime.datetime.now().strftime("%Y-%m")
+                month_tag = current_month_tag()
                 if gain > 0:
                     await db.execute("""
                         INSERT INTO transactions (sender_id, receiver_id, amount, type, description, month_tag)
@@ -1286,7 +1370,7 @@ class Economy(commands.Cog):
             return await interaction.response.send_message("❌ 1以上の金額を指定してください。", ephemeral=True)
         
         await interaction.response.defer(ephemeral=True)
-        month_tag = datetime.datetime.now().strftime("%Y-%m")
+        month_tag = current_month_tag()
 
         async with self.bot.get_db() as db:
             await db.execute("""
@@ -1316,11 +1400,6 @@ class Economy(commands.Cog):
                 """, (target.id, actual_deduction, f"【運営没収】{reason}", month_tag))
                 msg = f"✅ {target.mention} から **{actual_deduction:,} Stell** を没収しました。\n理由: `{reason}`"
 
-            # ここを追加 ↓
-            async with db.execute("SELECT value FROM server_config WHERE key = 'currency_log_id'") as c:
-                row = await c.fetchone()
-                log_ch_id = int(row['value']) if row else None
-
             await db.commit()
 
         embed = discord.Embed(title="⚙️ 運営資金操作ログ", color=Color.DANGER if action == "remove" else 0x00ff00)
@@ -1331,30 +1410,9 @@ class Economy(commands.Cog):
         embed.add_field(name="実行者", value=interaction.user.mention, inline=False)
         embed.timestamp = datetime.datetime.now()
 
-        # ここを削除 ↓（元の2回目のget_dbブロックをこれに置き換え）
-        if log_ch_id:
-            channel = self.bot.get_channel(log_ch_id)
-            if channel: await channel.send(embed=embed)
-
-        await interaction.followup.send(msg, ephemeral=True)
-            
         # 通貨ログチャンネルに通知を送る
-        embed = discord.Embed(title="⚙️ 運営資金操作ログ", color=Color.DANGER if action == "remove" else 0x00ff00)
-        embed.add_field(name="対象", value=target.mention, inline=True)
-        embed.add_field(name="操作", value="➕ 付与" if action == "add" else "➖ 没収", inline=True)
-        embed.add_field(name="金額", value=f"**{amount:,} S**" if action == "add" else f"**{actual_deduction:,} S**", inline=True)
-        embed.add_field(name="理由", value=reason, inline=False)
-        embed.add_field(name="実行者", value=interaction.user.mention, inline=False)
-        embed.timestamp = datetime.datetime.now()
-
-        log_ch_id = None
-        async with self.bot.get_db() as db:
-            async with db.execute("SELECT value FROM server_config WHERE key = 'currency_log_id'") as c:
-                row = await c.fetchone()
-                if row: log_ch_id = int(row['value'])
-        if log_ch_id:
-            channel = self.bot.get_channel(log_ch_id)
-            if channel: await channel.send(embed=embed)
+        channel = self.bot.config.get_channel('currency_log_id')
+        if channel: await channel.send(embed=embed)
 
         await interaction.followup.send(msg, ephemeral=True)
 
@@ -1574,14 +1632,7 @@ class Salary(commands.Cog):
         await interaction.followup.send(f"↩️ **ロールバック完了**\nID: `{batch_id}` の支給を回収しました。")
 
     async def send_salary_log(self, interaction, batch_id, total, count, breakdown, timestamp):
-        log_ch_id = None
-        async with self.bot.get_db() as db:
-            async with db.execute("SELECT value FROM server_config WHERE key = 'salary_log_id'") as c:
-                row = await c.fetchone()
-                if row: log_ch_id = int(row['value'])
-        
-        if not log_ch_id: return
-        channel = self.bot.get_channel(log_ch_id)
+        channel = self.bot.config.get_channel('salary_log_id')
         if not channel: return
 
         embed = discord.Embed(title="給与一斉送信ログ", color=Color.STELL, timestamp=timestamp)
@@ -1606,6 +1657,10 @@ class Jackpot(commands.Cog):
         self.max_number = 999
         self.seed_money = 300000    # 初期資金（100万から30万に減額してインフレ抑制）
 
+    async def cog_load(self):
+        # テーブル確認は起動時に1回だけ
+        await self.init_db()
+
     async def init_db(self):
         async with self.bot.get_db() as db:
             await db.execute("""
@@ -1625,8 +1680,6 @@ class Jackpot(commands.Cog):
 
     @app_commands.command(name="金庫状況", description="ステラの秘密の金庫の状況と、所持している解除コードを確認します")
     async def status(self, interaction: discord.Interaction):
-        await self.init_db()
-        
         async with self.bot.get_db() as db:
             async with db.execute("SELECT value FROM server_config WHERE key = 'jackpot_pool'") as c:
                 row = await c.fetchone()
@@ -1664,6 +1717,9 @@ class Jackpot(commands.Cog):
     @app_commands.describe(amount="生成回数")
     async def buy(self, interaction: discord.Interaction, amount: int):
         if amount <= 0: return await interaction.response.send_message("1回以上指定してください。", ephemeral=True)
+        # 1ラウンドの上限を超える指定は所持数に関係なく通らないので、DBを開く前に弾く
+        if amount > self.limit_per_round:
+            return await interaction.response.send_message(f"ステラ「ちょっと、ガッツきすぎよ！ 上限は {self.limit_per_round}回 までだからね！」", ephemeral=True)
         
         await interaction.response.defer(ephemeral=True)
         user = interaction.user
@@ -1811,17 +1867,18 @@ class Jackpot(commands.Cog):
 
 # ========== ヘルパー関数 ==========
 DICE_EMOJI = {1:"⚀", 2:"⚁", 3:"⚂", 4:"⚃", 5:"⚄", 6:"⚅"}
+DICE_FACES = (1, 2, 3, 4, 5, 6)
 
 def dice_str(dice):
     return " ".join(DICE_EMOJI[d] for d in dice)
 
-def judge_roll(dice):
-    """
-    Returns (role_name, score, mult)
-    mult: 5=ピンゾロ / 3=ゾロ目 / 2=シゴロ / None=目あり / -1=ヒフミ / 0=ハチ目
-    """
-    d = sorted(dice)
-    counts = {v: dice.count(v) for v in set(dice)}
+def roll_dice():
+    """サイコロ3個を1回の乱数呼び出しで振る"""
+    return random.choices(DICE_FACES, k=3)
+
+def _judge_sorted(d):
+    """役判定の本体（d はソート済みリスト）。起動時に全組み合わせ分だけ呼ぶ"""
+    counts = {v: d.count(v) for v in set(d)}
     if d == [1,1,1]:         return ("🌟 ピンゾロ！",      100,  5)
     if len(counts) == 1:     return (f"✨ ゾロ目({d[0]})", d[0]*10+50, 3)
     if d == [4,5,6]:         return ("🔥 シゴロ！",         99,   2)
@@ -1832,12 +1889,26 @@ def judge_roll(dice):
                 return (f"🎯 目あり({v})", v, None)
     return ("😶 ハチ目", 0, 0)
 
+# ソート済みの出目 (a<=b<=c) 56通りを a*36+b*6+c をキーに事前計算
+_ROLE_TABLE = {
+    a*36 + b*6 + c: _judge_sorted([a, b, c])
+    for a in DICE_FACES for b in range(a, 7) for c in range(b, 7)
+}
+
+def judge_roll(dice):
+    """
+    Returns (role_name, score, mult)
+    mult: 5=ピンゾロ / 3=ゾロ目 / 2=シゴロ / None=目あり / -1=ヒフミ / 0=ハチ目
+    """
+    a, b, c = sorted(dice)
+    return _ROLE_TABLE[a*36 + b*6 + c]
+
 def roll_until_role(max_tries=3):
     """役が出るまで最大3回。Returns (all_rolls, role_name, score, mult)"""
     all_rolls = []
     role_name, score, mult = "😶 ハチ目", 0, 0
     for _ in range(max_tries):
-        dice = [random.randint(1,6) for _ in range(3)]
+        dice = roll_dice()
         all_rolls.append(dice)
         role_name, score, mult = judge_roll(dice)
         if mult != 0:
@@ -1886,169 +1957,184 @@ def solo_reward_mult(mult):
 CHINCHIRO_LINES = {
 
     # ── 募集・開始 ──────────────────────────────────────
-    "start": [
+    "start": (
         "チンチロやるの？……まぁ、アタシが仕切ってあげる。感謝しなよ",
         "どうせ負けるくせに。……でも見てないと心配だから、仕方なく仕切る",
         "場所代はちゃんともらうから。それだけ覚えといて",
-    ],
-    "join": [
+    ),
+    "join": (
         "また来た。好きにしなよ",
         "参加するの？……来るなとは言ってない",
         "アンタも？……まぁ、いいけど",
-    ],
+    ),
 
     # ── 1投目実況 ──────────────────────────────────────
-    "roll1_hachi": [
+    "roll1_hachi": (
         "ハチ目ね。まだあるけど",
         "……ハチ目。次に期待すれば？",
         "1投目ハチ目か。まぁ、よくある",
-    ],
-    "roll1_good": [
+    ),
+    "roll1_good": (
         "おっ、いい目じゃん。続けなよ",
         "……ふーん、悪くない",
         "1投目から良い目。調子いいじゃん",
-    ],
-    "roll1_hifumi": [
+    ),
+    "roll1_hifumi": (
         "ヒフミ。……次頑張って",
         "あー、ヒフミか。まだ2投あるから",
-    ],
+    ),
 
     # ── 2投目実況 ──────────────────────────────────────
-    "roll2_hachi": [
+    "roll2_hachi": (
         "……またハチ目。ふふ、ヤバくない？",
         "2投連続ハチ目。次で決めなよ",
         "あー、またハチ目。最後に期待するしかないね",
-    ],
-    "roll2_reach": [
+    ),
+    "roll2_reach": (
         "おっ、リーチじゃん！最後決めなよ！",
         "2枚揃った！あと1個！……当たるといいね",
         "リーチ！ねえ、ドキドキする？アタシはしてないけど",
-    ],
-    "roll2_good": [
+    ),
+    "roll2_good": (
         "いい感じじゃん。最後も頼むよ",
         "……悪くない。続けて",
-    ],
+    ),
 
     # ── 3投目実況 ──────────────────────────────────────
-    "roll3_pinzoro": [
+    "roll3_pinzoro": (
         "っな！？ピンゾロ！？……ずるくない？",
         "ピンゾロじゃん！……まぁ、認める。すごかった",
         "え、ピンゾロ！？アタシびっくりしてないけど！？",
-    ],
-    "roll3_shigoro": [
+    ),
+    "roll3_shigoro": (
         "シゴロ！強いじゃん……まぁ",
         "シゴロか。……認めてあげる",
-    ],
-    "roll3_zorume": [
+    ),
+    "roll3_zorume": (
         "ゾロ目！……やるじゃん",
         "ゾロ目じゃん。……素直にすごいと思う",
-    ],
-    "roll3_miari": [
+    ),
+    "roll3_miari": (
         "目あり確定。……まぁよかったじゃん",
         "目あり。悪くない",
-    ],
-    "roll3_hifumi": [
+    ),
+    "roll3_hifumi": (
         "ヒフミ……。次は頑張って",
         "あー、ヒフミか。……気にしないで",
-    ],
-    "roll3_shonben": [
+    ),
+    "roll3_shonben": (
         "3投ともハチ目。ションベンじゃん♪ ざぁこ〜",
         "ぷぷぷっ！ションベン確定！ざぁこざぁこ♪",
         "あー全部ハチ目！ションベン！アタシ笑いすぎて死ぬ♪",
-    ],
+    ),
 
     # ── ションベン（1投目飛び）──────────────────────────
-    "shonben_fly": [
+    "shonben_fly": (
         "あっ飛んだ♪ ざぁこ確定〜！見た？今の！",
         "えっ飛んだじゃん！！ぷぷっ、ションベンじゃん！ざぁこ！",
         "サイコロ飛んでったじゃん♪ アタシ見てたよ〜！ざぁこざぁこ！",
         "っは！？飛んだ！？ぷぷぷっ！ションベン！最高！ざぁこ！",
-    ],
+    ),
 
     # ── 結果 ────────────────────────────────────────────
-    "child_win": [
+    "child_win": (
         "子が勝った。……まぁ、よくやった",
         "勝ったじゃん。……素直に認める、よかった",
-    ],
-    "host_sweep": [
+    ),
+    "host_sweep": (
         "親の完勝。……負けた人、まぁ次があるから",
         "全滅じゃん。……親が強かっただけで、みんなは悪くなかった",
-    ],
-    "host_win_partial": [
+    ),
+    "host_win_partial": (
         "親が勝ち越し。……負けた人お疲れ様",
         "まぁまぁの結果じゃん。……勝った人はよかった",
-    ],
-    "draw": [
+    ),
+    "draw": (
         "引き分け。……賭け金返るし、悪くないんじゃない",
-    ],
-    "timeout": [
+    ),
+    "timeout": (
         "……誰も来なかった。別にいいけど",
         "タイムアウト。……待ってたわけじゃないから",
-    ],
-    "broke": [
+    ),
+    "broke": (
         "残高足りてないじゃん。稼いできなよ",
         "お金ないの？……出直してきなよ",
-    ],
-    "cooldown": [
+    ),
+    "cooldown": (
         "{sec}秒待って。……急かさないで",
         "まだ早い。{sec}秒後にまた来て",
-    ],
+    ),
 
     # ── PVEソロ専用 ─────────────────────────────────────
-    "solo_start": [
+    "solo_start": (
         "一人でアタシに挑むの？……面白いじゃん、来なよ",
         "ソロ戦？……アタシが相手してあげる。覚悟はいい？",
         "一人で来たの。……まぁ、相手してあげる",
-    ],
-    "solo_sesta_roll1": [
+    ),
+    "solo_sesta_roll1": (
         "アタシの1投目……",
         "さて、アタシが振るよ……",
-    ],
-    "solo_sesta_roll2": [
+    ),
+    "solo_sesta_roll2": (
         "2投目……どうかな",
         "……続けるよ",
-    ],
-    "solo_sesta_roll3": [
+    ),
+    "solo_sesta_roll3": (
         "最後……",
         "決まるよ……",
-    ],
-    "solo_player_win": [
+    ),
+    "solo_player_win": (
         "……負けた。別に、悔しくないけど",
         "やるじゃん。……今日は調子悪かっただけだから",
         "勝ったの？……まぁ、認める。ちゃんと強かった",
-    ],
-    "solo_sesta_win": [
+    ),
+    "solo_sesta_win": (
         "アタシの勝ち。……まぁ、当然だけど",
         "ふふ、負けたじゃん。……次は頑張って",
         "アタシには勝てないよ。……また来ていいけど",
-    ],
-    "solo_draw": [
+    ),
+    "solo_draw": (
         "引き分けか。……まぁ、悪くないんじゃない",
         "引き分け。……賭け金返すよ",
-    ],
-    "solo_shonben_player": [
+    ),
+    "solo_shonben_player": (
         "あっ飛んだ♪ ざぁこ確定〜！見た？今の！",
         "えっ飛んだじゃん！！ぷぷっ、ションベンじゃん！ざぁこ！",
         "サイコロ飛んでったじゃん♪ アタシ見てたよ〜！ざぁこざぁこ！",
-    ],
-    "solo_shonben_sesta": [
+    ),
+    "solo_shonben_sesta": (
         "あっ……飛んだ。……見なかったことにして",
         "えっ飛んだ！？……今のはノーカンで",
         "っな！？アタシのサイコロが！……これは事故だから！",
-    ],
+    ),
 }
 
+_NO_LINE = ("……",)
+
 def c_line(key: str, **kwargs) -> str:
-    lines = CHINCHIRO_LINES.get(key, ["……"])
+    lines = CHINCHIRO_LINES.get(key, _NO_LINE)
     line  = random.choice(lines)
     return line.format(**kwargs) if kwargs else line
 
+# 役倍率 → 実況セリフのキー（該当なしはそれぞれ roll1_good / roll3_shonben）
+ROLL1_LINE_KEY = {0: "roll1_hachi", -1: "roll1_hifumi"}
+ROLL3_LINE_KEY = {
+    5:    "roll3_pinzoro",
+    2:    "roll3_shigoro",
+    3:    "roll3_zorume",
+    None: "roll3_miari",
+    -1:   "roll3_hifumi",
+}
+SOLO_SESTA_ROLL_KEYS = ("solo_sesta_roll1", "solo_sesta_roll2", "solo_sesta_roll3")
+
 
 # ================================================================
 #   セッションクラス
 # ================================================================
 
 class ChinchiroSession:
+    __slots__ = ("host", "bet", "channel_id", "players", "phase", "started_at")
+
     def __init__(self, host, bet, channel_id):
         self.host       = host
         self.bet        = bet
@@ -2083,8 +2169,8 @@ class ChinchiroRecruitView(discord.ui.View):
 
         venue_fee = int(s.bet * Chinchiro.VENUE_RATE)
         async with self.cog.bot.get_db() as db:
-            bal = await self.cog._get_stell(db, user.id)
-        if bal < s.bet + venue_fee:
+            enough = await self.cog._has_stell(db, user.id, s.bet + venue_fee)
+        if not enough:
             return await interaction.response.send_message(
                 f"セスタ「{c_line('broke')}」", ephemeral=True
             )
@@ -2113,8 +2199,7 @@ class ChinchiroRecruitView(discord.ui.View):
             )
 
         s.phase = "rolling"
-        for child in self.children:
-            child.disabled = True
+        self._lock_buttons()
         await interaction.response.edit_message(view=self)
         await self.cog._execute_pvp(interaction, s)
 
@@ -2122,8 +2207,12 @@ class ChinchiroRecruitView(discord.ui.View):
         ch_id = self.session.channel_id
         if ch_id in self.cog.sessions:
             del self.cog.sessions[ch_id]
-        for child in self.children:
-            child.disabled = True
+        self._lock_buttons()
+
+    def _lock_buttons(self):
+        # デコレータで生成されたボタンはインスタンス属性に束縛されているので直接触る
+        self.join_btn.disabled  = True
+        self.start_btn.disabled = True
 
     async def _update_panel(self, interaction: discord.Interaction):
         s         = self.session
@@ -2152,6 +2241,9 @@ class Chinchiro(commands.Cog):
     COOLDOWN_SECONDS = 10
     VENUE_RATE       = 0.03
     SHONBEN_RATE     = 0.03
+    # ソロ戦はプレイヤーがションベンしなかった時だけセスタ側を判定するので、
+    # 1回の乱数で [0, RATE) をプレイヤー、続く (1-RATE)*RATE 幅をセスタに割り当てる
+    SOLO_SESTA_SHONBEN_CUT = SHONBEN_RATE + (1 - SHONBEN_RATE) * SHONBEN_RATE
 
     BET_CHOICES = [
         app_commands.Choice(name="1000 Stell",     value=1000),
@@ -2165,17 +2257,28 @@ class Chinchiro(commands.Cog):
     def __init__(self, bot):
         self.bot       = bot
         self.sessions  : dict = {}
-        self.cooldowns : dict = {}
+        self.cooldowns : dict = {}   # {user_id: クールダウン終了時刻 (time.monotonic)}
 
     def _check_cd(self, user_id) -> int | None:
-        if user_id in self.cooldowns:
-            rem = self.COOLDOWN_SECONDS - (
-                datetime.datetime.now() - self.cooldowns[user_id]
-            ).total_seconds()
-            if rem > 0:
-                return int(rem) + 1
+        deadline = self.cooldowns.get(user_id)
+        if deadline is None:
+            return None
+        rem = deadline - time.monotonic()
+        if rem > 0:
+            return int(rem) + 1
+        del self.cooldowns[user_id]
         return None
 
+    def _set_cd(self, *user_ids):
+        now = time.monotonic()
+        # 期限切れのエントリを掃除して辞書が増え続けないようにする
+        expired = [uid for uid, deadline in self.cooldowns.items() if deadline <= now]
+        for uid in expired:
+            del self.cooldowns[uid]
+        deadline = now + self.COOLDOWN_SECONDS
+        for uid in user_ids:
+            self.cooldowns[uid] = deadline
+
     async def _get_stell(self, db, user_id: int) -> int:
         async with db.execute(
             "SELECT balance FROM accounts WHERE user_id = ?", (user_id,)
@@ -2183,6 +2286,22 @@ class Chinchiro(commands.Cog):
             row = await c.fetchone()
         return row["balance"] if row else 0
 
+    async def _has_stell(self, db, user_id: int, amount: int) -> bool:
+        # 残高を取り出さずSQL側で比較だけ行う
+        async with db.execute(
+            "SELECT 1 FROM accounts WHERE user_id = ? AND balance >= ?", (user_id, amount)
+        ) as c:
+            return await c.fetchone() is not None
+
+    async def _funded_ids(self, db, user_ids: list, amount: int) -> set:
+        """amount 以上の残高を持つユーザーIDの集合（複数人を1クエリで判定）"""
+        marks = ",".join("?" * len(user_ids))
+        async with db.execute(
+            f"SELECT user_id FROM accounts WHERE user_id IN ({marks}) AND balance >= ?",
+            (*user_ids, amount)
+        ) as c:
+            return {row["user_id"] for row in await c.fetchall()}
+
     async def _add_stell(self, db, user_id: int, amount: int):
         await db.execute("""
             INSERT INTO accounts (user_id, balance, total_earned)
@@ -2190,15 +2309,14 @@ class Chinchiro(commands.Cog):
             ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
         """, (user_id, amount))
 
-    async def _sub_stell(self, db, user_id: int, amount: int) -> bool:
-        bal = await self._get_stell(db, user_id)
-        if bal < amount:
-            return False
-        await db.execute(
-            "UPDATE accounts SET balance = balance - ? WHERE user_id = ?",
-            (amount, user_id)
+    async def _sub_all_stell(self, db, user_ids: list, amount: int) -> bool:
+        """全員から amount を引き落とす。1人でも足りなければ何もせず False（呼び出し側で rollback）"""
+        marks = ",".join("?" * len(user_ids))
+        cur = await db.execute(
+            f"UPDATE accounts SET balance = balance - ? WHERE user_id IN ({marks}) AND balance >= ?",
+            (amount, *user_ids, amount)
         )
-        return True
+        return cur.rowcount == len(user_ids)
 
     # ── /チンチロ ─────────────────────────────────────────
     @app_commands.command(name="チンチロ", description="チンチロの親になってゲームを開始します（Stell）")
@@ -2223,8 +2341,8 @@ class Chinchiro(commands.Cog):
 
         venue_fee = int(bet * self.VENUE_RATE)
         async with self.bot.get_db() as db:
-            bal = await self._get_stell(db, user.id)
-        if bal < bet + venue_fee:
+            enough = await self._has_stell(db, user.id, bet + venue_fee)
+        if not enough:
             return await interaction.response.send_message(
                 f"セスタ「{c_line('broke')}」", ephemeral=True
             )
@@ -2250,28 +2368,25 @@ class Chinchiro(commands.Cog):
         venue_fee   = int(bet * self.VENUE_RATE)
         all_members = [s.host] + s.players
 
-        # 残高チェック（Stell）
-        broke = []
+        # 全員からStell引き落とし（残高チェック込み・全員成功か全員失敗）
+        member_ids = [m.id for m in all_members]
         async with self.bot.get_db() as db:
-            for m in all_members:
-                bal = await self._get_stell(db, m.id)
-                if bal < bet + venue_fee:
-                    broke.append(m)
-        if broke:
+            debited = await self._sub_all_stell(db, member_ids, bet + venue_fee)
+            if debited:
+                await db.commit()
+            else:
+                await db.rollback()
+                funded = await self._funded_ids(db, member_ids, bet + venue_fee)
+                broke  = [m for m in all_members if m.id not in funded]
+        if not debited:
             s.phase = "recruiting"
             return await interaction.channel.send(
                 f"❌ 残高不足: {', '.join(m.display_name for m in broke)}\n"
                 f"セスタ「{c_line('broke')}」"
             )
 
-        # 全員からStell引き落とし
-        async with self.bot.get_db() as db:
-            for m in all_members:
-                await self._sub_stell(db, m.id, bet + venue_fee)
-            await db.commit()
-
         total_burn = venue_fee * len(all_members)
-        month_tag  = datetime.datetime.now().strftime("%Y-%m")
+        month_tag  = current_month_tag()
         num_children = len(s.players)
 
         # ── 親のサイコロ演出 ──────────────────────────────
@@ -2288,7 +2403,7 @@ class Chinchiro(commands.Cog):
             await asyncio.sleep(0.8)
             embed.description = (
                 f"**親:** {s.host.mention}\n\n"
-                f"🎲 {dice_str([random.randint(1,6) for _ in range(3)])} ← 飛んだ！\n\n"
+                f"🎲 {dice_str(roll_dice())} ← 飛んだ！\n\n"
                 f"💦 **ションベン！** 親の即負け！\n"
                 f"セスタ「{c_line('shonben_fly')}」"
             )
@@ -2301,9 +2416,7 @@ class Chinchiro(commands.Cog):
                     await self._add_stell(db, m.id, bet * 2)
                 await db.commit()
 
-            now = datetime.datetime.now()
-            for m in all_members:
-                self.cooldowns[m.id] = now
+            self._set_cd(*(m.id for m in all_members))
             if s.channel_id in self.sessions:
                 del self.sessions[s.channel_id]
             return
@@ -2435,9 +2548,7 @@ class Chinchiro(commands.Cog):
         )
         await msg.edit(embed=result_embed)
 
-        now = datetime.datetime.now()
-        for m in all_members:
-            self.cooldowns[m.id] = now
+        self._set_cd(*(m.id for m in all_members))
         if s.channel_id in self.sessions:
             del self.sessions[s.channel_id]
 
@@ -2456,27 +2567,17 @@ class Chinchiro(commands.Cog):
 
             # セリフ選択
             if i == 0:
-                _, _, m0 = judge_roll(dice)
-                if m0 == 0:    selife = c_line("roll1_hachi")
-                elif m0 == -1: selife = c_line("roll1_hifumi")
-                else:          selife = c_line("roll1_good")
+                selife = c_line(ROLL1_LINE_KEY.get(tmp_mult, "roll1_good"))
             elif i == 1:
-                _, _, m1 = judge_roll(dice)
                 # 前の目と合わせてリーチ判定
-                prev = rolls[0]
-                if m1 == 0:
+                if tmp_mult == 0:
                     selife = c_line("roll2_hachi")
                 elif any(dice.count(v) >= 2 for v in dice):
                     selife = c_line("roll2_reach")
                 else:
                     selife = c_line("roll2_good")
             else:
-                if mult == 5:      selife = c_line("roll3_pinzoro")
-                elif mult == 2:    selife = c_line("roll3_shigoro")
-                elif mult == 3:    selife = c_line("roll3_zorume")
-                elif mult is None: selife = c_line("roll3_miari")
-                elif mult == -1:   selife = c_line("roll3_hifumi")
-                else:              selife = c_line("roll3_shonben")
+                selife = c_line(ROLL3_LINE_KEY.get(mult, "roll3_shonben"))
 
             suffix = f"**{role_name}**" if is_last else "ハチ目"
             all_parts.append(f"　{i+1}投目: {dice_str(dice)} {suffix}")
@@ -2486,8 +2587,8 @@ class Chinchiro(commands.Cog):
                 + "\n".join(all_parts)
                 + f"\n\nセスタ「{selife}」"
             )
-            await msg.edit(embed=embed)
-            await asyncio.sleep(1.0)
+            # 編集のHTTP往復を演出の待ち時間に重ねる（1投ごとに1回だけ編集）
+            await asyncio.gather(msg.edit(embed=embed), asyncio.sleep(1.0))
 
         return rolls, role_name, score, mult
 
@@ -2553,42 +2654,25 @@ class Chinchiro(commands.Cog):
             )
 
 # ── 日次プレイ上限チェック ──
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
-        daily_limit = await _cfg(self.bot, "chinchiro_daily_limit")
-        async with self.bot.get_db() as db:
-            async with db.execute(
-                "SELECT 1 FROM daily_play_exemptions WHERE user_id=? AND game='chinchiro' AND date=?",
-                (user.id, today)
-            ) as c:
-                exempt = await c.fetchone()
-            async with db.execute(
-                "SELECT count FROM daily_play_counts WHERE user_id=? AND game='chinchiro' AND date=?",
-                (user.id, today)
-            ) as c:
-                row = await c.fetchone()
-            play_count = row["count"] if row else 0
-        if not exempt and play_count >= daily_limit:
-            return await interaction.response.send_message(
-                f"🚫 今日のチンチロ上限（**{daily_limit}回**）に達したよ！また明日ね〜♪",
-                ephemeral=True
-            )
+        today = datetime.date.today().isoformat()
+        daily_limit = _cfg(self.bot, "chinchiro_daily_limit")
 
         venue_fee = int(bet * 0.02)   # ソロは場所代2%
-        bal       = await cesta_cog.get_balance(user.id)
-        if bal < bet + venue_fee:
-            return await interaction.response.send_message(
-                f"セスタ「{c_line('broke')}」", ephemeral=True
-            )
 
-        # 場所代引き落とし＆プレイカウント記録
+        # プレイ枠確保＆残高チェック＆場所代引き落とし（1接続・1トランザクション）
         async with self.bot.get_db() as db:
-            await cesta_cog.sub_balance(db, user.id, bet + venue_fee)
+            if not await claim_daily_slot(db, user.id, "chinchiro", today, daily_limit):
+                await db.rollback()
+                return await interaction.response.send_message(
+                    f"🚫 今日のチンチロ上限（**{daily_limit}回**）に達したよ！また明日ね〜♪",
+                    ephemeral=True
+                )
+            if not await cesta_cog.sub_balance(db, user.id, bet + venue_fee):
+                await db.rollback()
+                return await interaction.response.send_message(
+                    f"セスタ「{c_line('broke')}」", ephemeral=True
+                )
             newly = await cesta_cog.record_spend(db, user.id, bet + venue_fee)
-            await db.execute("""
-                INSERT INTO daily_play_counts (user_id, game, date, count)
-                VALUES (?, 'chinchiro', ?, 1)
-                ON CONFLICT(user_id, game, date) DO UPDATE SET count = count + 1
-            """, (user.id, today))
             await db.commit()
 
         embed = discord.Embed(
@@ -2604,20 +2688,21 @@ class Chinchiro(commands.Cog):
         msg = await interaction.followup.send(embed=embed)
 
 
-        # ── プレイヤーのションベンチェック ──
-        player_shonben = random.random() < self.SHONBEN_RATE
+        # ── プレイヤーのションベンチェック（セスタ側も同じ乱数で決める） ──
+        shonben_roll   = random.random()
+        player_shonben = shonben_roll < self.SHONBEN_RATE
 
         if player_shonben:
             await asyncio.sleep(0.8)
             embed.description = (
                 f"**{user.display_name}** の1投目\n\n"
-                f"🎲 {dice_str([random.randint(1,6) for _ in range(3)])} ← 飛んだ！\n\n"
+                f"🎲 {dice_str(roll_dice())} ← 飛んだ！\n\n"
                 f"💦 **ションベン！** アンタの即負け！\n"
                 f"セスタ「{c_line('solo_shonben_player')}」"
             )
             embed.color = 0x4444ff
             await msg.edit(embed=embed)
-            self.cooldowns[user.id] = datetime.datetime.now()
+            self._set_cd(user.id)
             return
 
         # ── プレイヤーのロール ──
@@ -2626,29 +2711,28 @@ class Chinchiro(commands.Cog):
         )
 
         # ── セスタのションベンチェック ──
-        sesta_shonben = random.random() < self.SHONBEN_RATE
+        sesta_shonben = shonben_roll < self.SOLO_SESTA_SHONBEN_CUT
 
         if sesta_shonben:
-            await asyncio.sleep(0.8)
-            s_parts = [f"　1投目: {dice_str([random.randint(1,6) for _ in range(3)])} ← 飛んだ！"]
-            embed.description = (
+            s_parts = [f"　1投目: {dice_str(roll_dice())} ← 飛んだ！"]
+            shonben_desc = (
                 f"👾 セスタの番\n\n"
                 + "\n".join(s_parts)
                 + f"\n\n💦 **ションベン！** セスタの即負け！\n"
                 f"セスタ「{c_line('solo_shonben_sesta')}」"
             )
-            embed.color = 0x00ff88
-            await msg.edit(embed=embed)
 
             # プレイヤーに報酬
             reward = int(bet * 2.0)
             async with self.bot.get_db() as db:
-                await cesta_cog.add_balance(db, user.id, reward)
+                new_bal = await cesta_cog.add_balance(db, user.id, reward)
                 await db.commit()
 
-            new_bal = await cesta_cog.get_balance(user.id)
+            # 飛んだ演出は直後に結果で上書きされていたので、結果Embedにまとめて1回だけ編集する
+            await asyncio.sleep(0.8)
             result_embed = discord.Embed(
                 title="🎲 チンチロ ソロ戦 結果",
+                description=shonben_desc,
                 color=Color.SUCCESS
             )
             result_embed.add_field(
@@ -2659,13 +2743,12 @@ class Chinchiro(commands.Cog):
             result_embed.add_field(name="残高", value=f"{new_bal:,} セスタ", inline=True)
             result_embed.set_footer(text=f"場所代: {venue_fee:,} セスタ Burn")
             await msg.edit(embed=result_embed)
-            self.cooldowns[user.id] = datetime.datetime.now()
+            self._set_cd(user.id)
             return
 
         # ── セスタのロール演出 ──
         embed.description = f"👾 セスタの番…\nセスタ「{c_line('solo_sesta_roll1')}」"
-        await msg.edit(embed=embed)
-        await asyncio.sleep(0.8)
+        await asyncio.gather(msg.edit(embed=embed), asyncio.sleep(0.8))
 
         s_rolls    = []
         s_role     = "😶 ハチ目"
@@ -2674,25 +2757,22 @@ class Chinchiro(commands.Cog):
         s_parts    = []
 
         for i in range(3):
-            dice = [random.randint(1, 6) for _ in range(3)]
+            dice = roll_dice()
             s_rolls.append(dice)
-            s_role_tmp, s_score_tmp, s_mult_tmp = judge_roll(dice)[0], judge_roll(dice)[1], judge_roll(dice)[2]
+            s_role_tmp, s_score_tmp, s_mult_tmp = judge_roll(dice)
 
             is_last = (i == 2) or (s_mult_tmp != 0)
             suffix  = f"**{s_role_tmp}**" if is_last else "ハチ目"
             s_parts.append(f"　{i+1}投目: {dice_str(dice)} {suffix}")
 
-            if i == 0:   selife = c_line("solo_sesta_roll1")
-            elif i == 1: selife = c_line("solo_sesta_roll2")
-            else:        selife = c_line("solo_sesta_roll3")
+            selife = c_line(SOLO_SESTA_ROLL_KEYS[i])
 
             embed.description = (
                 f"👾 セスタの番\n\n"
                 + "\n".join(s_parts)
                 + f"\nセスタ「{selife}」"
             )
-            await msg.edit(embed=embed)
-            await asyncio.sleep(1.0)
+            await asyncio.gather(msg.edit(embed=embed), asyncio.sleep(1.0))
 
             if s_mult_tmp != 0:
                 s_role  = s_role_tmp
@@ -2703,7 +2783,7 @@ class Chinchiro(commands.Cog):
         # ── 勝敗判定 ──
         outcome = determine_outcome(s_mult, s_score, p_mult, p_score)
 
-        month_tag = datetime.datetime.now().strftime("%Y-%m")
+        month_tag = current_month_tag()
         payout    = 0
 
         async with self.bot.get_db() as db:
@@ -2711,14 +2791,15 @@ class Chinchiro(commands.Cog):
                 reward_mult = solo_reward_mult(p_mult)
                 payout      = int(bet * reward_mult)
                 logger.info(f"[SOLO DEBUG] p_mult={p_mult}, reward_mult={reward_mult}, bet={bet}, payout={payout}")
-                await cesta_cog.add_balance(db, user.id, payout)
+                new_bal = await cesta_cog.add_balance(db, user.id, payout)
             elif outcome == "draw":
                 payout = bet
-                await cesta_cog.add_balance(db, user.id, payout)
-            # 負けは没収のまま
+                new_bal = await cesta_cog.add_balance(db, user.id, payout)
+            else:
+                # 負けは没収のまま（残高は同じ接続で読む）
+                new_bal = await cesta_cog.get_balance(user.id, db)
             await db.commit()
 
-        new_bal = await cesta_cog.get_balance(user.id)
         net     = payout - bet
 
         # ── 結果Embed ──
@@ -2762,89 +2843,94 @@ class Chinchiro(commands.Cog):
         result_embed.set_footer(text=f"賭け金: {bet:,} セスタ | 場所代: {venue_fee:,} セスタ Burn")
 
         await msg.edit(embed=result_embed)
-        self.cooldowns[user.id] = datetime.datetime.now()
+        self._set_cd(user.id)
 
 
 BLACKJACK_LINES = {
-    "deal": [
+    "deal": (
         "えー、またアタシがやるのー？まぁいっか、負けないし♪",
         "来たんだ。……勝てると思ってるなら、お生憎様だけど？",
         "しょうがないなぁ。アタシに勝ちたいなら付き合ってあげる♡",
-    ],
-    "player_hit": [
+    ),
+    "player_hit": (
         "まだ引くの〜？無謀だぁ♪",
         "ふーん、強気じゃん。バーストしても知らないよ？",
         "あーそっちいくんだ。まぁ好きにしたら〜",
-    ],
-    "player_stand": [
+    ),
+    "player_stand": (
         "あ、止まるんだ。賢い選択じゃない……かもね♪",
         "スタンドか〜。じゃあアタシの番ね、見てて？",
         "そこで止まるの？ま、どうせアタシが勝つけど〜♡",
-    ],
-    "player_bust": [
+    ),
+    "player_bust": (
         "あっははは！バーストじゃん、ザコすぎ♪",
         "あらら〜、バーストしちゃった。もっとうまくやってよね",
         "えー、バースト？アタシとやるには早かったかなぁ♡",
-    ],
-    "sesta_bust": [
+    ),
+    "sesta_bust": (
         "ちょ……っ！？な、なんでバーストしてんの！？ありえないんだけど！",
         "うそ、バースト！？……これは事故。完全に事故だから！",
         "……バーストした。……見なかったことにして？",
-    ],
-    "player_win": [
+    ),
+    "player_win": (
         "……まぁ、今回は負けてあげたってだけだから。勘違いしないでよね",
         "ちょっと！なんで勝ってんの！ズルしてない？してないか……",
         "むぅ……認めてあげる。今回だけだけど♪",
-    ],
-    "sesta_win": [
+    ),
+    "sesta_win": (
         "ふふ〜ん、アタシの勝ち♡ 当然でしょ？",
         "えへへ、やっぱアタシには勝てないよ〜♪",
         "ざーんねん♡ アタシ結構強いんだよね〜",
-    ],
-    "draw": [
+    ),
+    "draw": (
         "引き分け〜？なんか物足りないなぁ",
         "あ〜引き分けか。もうちょっと頑張ってよ、張り合いない♪",
         "引き分けかぁ。……まぁ悪くはないけど、次は負かすから",
-    ],
-    "blackjack": [
+    ),
+    "blackjack": (
         "ちょ……っ！ブラックジャック！？ずるい！絶対ずるい！",
         "えっ、うそ、なんで！？……お、おめでとう。一応ね♡",
         "ブラックジャック……はぁ、すごいじゃん。認めたくないけど認める",
-    ],
+    ),
 }
 
 CARD_SUITS = ["♠", "♥", "♦", "♣"]
 CARD_RANKS = ["A", "2", "3", "4", "5", "6", "7", "8", "9", "10", "J", "Q", "K"]
 
+# ランク → 点数（Aは11で数え、バースト時に bj_hand_value で1に落とす）
+BJ_CARD_VALUES = {r: 10 if r in ("J", "Q", "K") else 11 if r == "A" else int(r) for r in CARD_RANKS}
+
 def bj_card_value(rank):
-    if rank in ["J", "Q", "K"]: return 10
-    if rank == "A": return 11
-    return int(rank)
+    return BJ_CARD_VALUES[rank]
 
 def bj_hand_value(hand):
-    total = sum(bj_card_value(r) for r, _ in hand)
+    total = sum(BJ_CARD_VALUES[r] for r, _ in hand)
     aces = sum(1 for r, _ in hand if r == "A")
     while total > 21 and aces:
         total -= 10
         aces -= 1
     return total
 
+# カードの表示文字列と手札表示の枠は固定なので起動時に作っておく
+BJ_CARD_FACES = {(r, s): f"{s}{r}" for s in CARD_SUITS for r in CARD_RANKS}
+BJ_HIDDEN_CARD = "🂠"
+BJ_HANDS_TEMPLATE = "**あなたの手札**: {}  `{}`\n**セスタの手札**: {}  `{}`\n"
+
 def bj_card_str(hand, hide_second=False):
-    cards = []
-    for i, (r, s) in enumerate(hand):
-        if i == 1 and hide_second:
-            cards.append("🂠")
-        else:
-            cards.append(f"{s}{r}")
-    return "  ".join(cards)
+    faces = [BJ_CARD_FACES[card] for card in hand]
+    if hide_second and len(faces) > 1:
+        faces[1] = BJ_HIDDEN_CARD
+    return "  ".join(faces)
+
+BJ_FULL_DECK = tuple((r, s) for s in CARD_SUITS for r in CARD_RANKS)
 
 def bj_new_deck():
-    deck = [(r, s) for s in CARD_SUITS for r in CARD_RANKS]
+    deck = list(BJ_FULL_DECK)
     random.shuffle(deck)
     return deck
 
 def c_line_bj(key):
-    lines = BLACKJACK_LINES.get(key, ["……"])
+    lines = BLACKJACK_LINES.get(key, _NO_LINE)
     return random.choice(lines)
 
 
@@ -2859,22 +2945,23 @@ class BlackjackView(discord.ui.View):
         self.deck        = deck
         self.cesta_cog   = cesta_cog
         self.done        = False
+        # 毎回 Embed を作り直さず、同じものの本文・色・フッターだけ差し替える
+        self.embed       = discord.Embed(title="🃏 ブラックジャック vsセスタ")
 
     def _embed(self, hide_sesta=True, result_text="", color=Color.GAMBLE):
         p_val = bj_hand_value(self.player)
         s_val = bj_hand_value(self.sesta)
-        desc = (
-            f"**あなたの手札**: {bj_card_str(self.player)}  `{p_val}`\n"
-            f"**セスタの手札**: {bj_card_str(self.sesta, hide_second=hide_sesta)}  "
-            f"`{'?' if hide_sesta else s_val}`\n"
+        desc = BJ_HANDS_TEMPLATE.format(
+            bj_card_str(self.player), p_val,
+            bj_card_str(self.sesta, hide_second=hide_sesta), "?" if hide_sesta else s_val
         )
         if result_text:
             desc += f"\n{result_text}"
-        return discord.Embed(
-            title="🃏 ブラックジャック vsセスタ",
-            description=desc,
-            color=color
-        )
+        embed = self.embed
+        embed.description = desc
+        embed.color = color
+        embed.remove_footer()
+        return embed
 
     async def _finish(self, interaction):
         if self.done: return
@@ -2972,41 +3059,8 @@ class Blackjack(commands.Cog):
         cesta_cog = self.bot.get_cog("CestaSystem")
 
 # ── 日次プレイ上限チェック ──
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
-        daily_limit = await _cfg(self.bot, "slot_daily_limit")
-        async with self.bot.get_db() as db:
-            async with db.execute(
-                "SELECT 1 FROM daily_play_exemptions WHERE user_id=? AND game='blackjack' AND date=?",
-                (user.id, today)
-            ) as c:
-                exempt = await c.fetchone()
-            async with db.execute(
-                "SELECT count FROM daily_play_counts WHERE user_id=? AND game='blackjack' AND date=?",
-                (user.id, today)
-            ) as c:
-                row = await c.fetchone()
-            play_count = row["count"] if row else 0
-        if not exempt and play_count >= daily_limit:
-            return await interaction.response.send_message(
-                f"🚫 今日のブラックジャック上限（**{daily_limit}回**）に達したよ！また明日ね〜",
-                ephemeral=True
-            )
-        
-        bal = await cesta_cog.get_balance(user.id)
-        if bal < bet:
-            return await interaction.response.send_message(
-                f"セスタ「残高が足りないじゃん。」", ephemeral=True
-            )
-
-        async with self.bot.get_db() as db:
-            await cesta_cog.sub_balance(db, user.id, bet)
-            await cesta_cog.record_spend(db, user.id, bet)
-            await db.execute("""
-                INSERT INTO daily_play_counts (user_id, game, date, count)
-                VALUES (?, 'blackjack', ?, 1)
-                ON CONFLICT(user_id, game, date) DO UPDATE SET count = count + 1
-            """, (user.id, today))
-            await db.commit()
+        today = datetime.date.today().isoformat()
+        daily_limit = _cfg(self.bot, "slot_daily_limit")
 
         deck        = bj_new_deck()
         player_hand = [deck.pop(), deck.pop()]
@@ -3015,29 +3069,39 @@ class Blackjack(commands.Cog):
         p_val = bj_hand_value(player_hand)
         s_val = bj_hand_value(sesta_hand)
 
+        async with self.bot.get_db() as db:
+            if not await claim_daily_slot(db, user.id, "blackjack", today, daily_limit):
+                await db.rollback()
+                return await interaction.response.send_message(
+                    f"🚫 今日のブラックジャック上限（**{daily_limit}回**）に達したよ！また明日ね〜",
+                    ephemeral=True
+                )
+            if not await cesta_cog.sub_balance(db, user.id, bet):
+                await db.rollback()
+                return await interaction.response.send_message(
+                    f"セスタ「残高が足りないじゃん。」", ephemeral=True
+                )
+            await cesta_cog.record_spend(db, user.id, bet)
+            # 配牌で決着する場合は払い戻しまで同じトランザクションで済ませる
+            if p_val == 21:
+                # 両者BJ → 引き分け、賭け金をそのまま返す / プレイヤーのみBJ → 2.5倍
+                payout = bet if s_val == 21 else int(bet * 2.5)
+                await cesta_cog.add_balance(db, user.id, payout)
+            await db.commit()
+
         if p_val == 21:
             if s_val == 21:
-                # 両者BJ → 引き分け、賭け金をそのまま返す
-                payout = bet
-                async with self.bot.get_db() as db:
-                    await cesta_cog.add_balance(db, user.id, payout)
-                    await db.commit()
                 result = f"🟡 **引き分け（両者ブラックジャック）！**\nセスタ「{c_line_bj('draw')}」\n\n賭け金: **{bet:,} セスタ** | 結果: **±0 セスタ**"
                 embed = discord.Embed(title="🃏 ブラックジャック vsセスタ", description=(
-                    f"**あなたの手札**: {bj_card_str(player_hand)}  `{p_val}`\n"
-                    f"**セスタの手札**: {bj_card_str(sesta_hand)}  `{s_val}`\n\n{result}"
+                    BJ_HANDS_TEMPLATE.format(bj_card_str(player_hand), p_val, bj_card_str(sesta_hand), s_val)
+                    + f"\n{result}"
                 ), color=Color.STELL)
                 return await interaction.response.send_message(embed=embed, ephemeral=True)
 
-            # プレイヤーのみBJ → 2.5倍
-            payout = int(bet * 2.5)
-            async with self.bot.get_db() as db:
-                await cesta_cog.add_balance(db, user.id, payout)
-                await db.commit()
             result = f"🌟 **ブラックジャック！**\nセスタ「{c_line_bj('blackjack')}」\n\n賭け金: **{bet:,} セスタ** | 結果: **+{payout - bet:,} セスタ**"
             embed = discord.Embed(title="🃏 ブラックジャック vsセスタ", description=(
-                f"**あなたの手札**: {bj_card_str(player_hand)}  `{p_val}`\n"
-                f"**セスタの手札**: {bj_card_str(sesta_hand)}  `{s_val}`\n\n{result}"
+                BJ_HANDS_TEMPLATE.format(bj_card_str(player_hand), p_val, bj_card_str(sesta_hand), s_val)
+                + f"\n{result}"
             ), color=Color.STELL)
             return await interaction.response.send_message(embed=embed, ephemeral=True)
 
@@ -3049,6 +3113,9 @@ class Blackjack(commands.Cog):
 # ── Grand Opening カウントダウン ──
 OPEN_AT = datetime.datetime(2026, 2, 26, 0, 0, 0,
                              tzinfo=datetime.timezone(datetime.timedelta(hours=9)))
+# 毎分の更新で変わらない部分は先に作っておく
+COUNTDOWN_BAR_LEN = 20
+COUNTDOWN_FOOTER  = f"STELLA — Pre-Open  |  <t:{int(OPEN_AT.timestamp())}:F> OPEN"
 
 def build_countdown_embed(now: datetime.datetime) -> discord.Embed:
     diff = OPEN_AT - now
@@ -3070,10 +3137,9 @@ def build_countdown_embed(now: datetime.datetime) -> discord.Embed:
     h = total_sec // 3600
     m = (total_sec % 3600) // 60
     s = total_sec % 60
-    bar_len = 20
-    filled = int((1 - diff.total_seconds() / (24 * 3600)) * bar_len)
-    filled = max(0, min(bar_len, filled))
-    bar = "█" * filled + "░" * (bar_len - filled)
+    filled = int((1 - diff.total_seconds() / (24 * 3600)) * COUNTDOWN_BAR_LEN)
+    filled = max(0, min(COUNTDOWN_BAR_LEN, filled))
+    bar = "█" * filled + "░" * (COUNTDOWN_BAR_LEN - filled)
     embed = discord.Embed(
         description=(
             "```\n"
@@ -3085,8 +3151,7 @@ def build_countdown_embed(now: datetime.datetime) -> discord.Embed:
         ),
         color=Color.STOCK
     )
-    open_ts = int(OPEN_AT.timestamp())
-    embed.set_footer(text=f"STELLA — Pre-Open  |  <t:{open_ts}:F> OPEN")
+    embed.set_footer(text=COUNTDOWN_FOOTER)
     return embed
 
 
@@ -3161,15 +3226,17 @@ class Countdown(commands.Cog):
 
         
 # ── 色定義 ──
-def ansi(text, color_code): return f"\x1b[{color_code}m{text}\x1b[0m"
-def gold(t): return ansi(t, "1;33")
-def red(t): return ansi(t, "1;31")
-def green(t): return ansi(t, "1;32")
-def pink(t): return ansi(t, "1;35")
-def gray(t): return ansi(t, "1;30")
-def blue(t): return ansi(t, "1;34")
-def yellow(t): return ansi(t, "1;33")
-def white(t): return ansi(t, "1;37")
+# 色ごとのエスケープは固定なので、ansi() を経由せず直接埋め込む
+ANSI_RESET = "\x1b[0m"
+def ansi(text, color_code): return f"\x1b[{color_code}m{text}{ANSI_RESET}"
+def gold(t): return f"\x1b[1;33m{t}{ANSI_RESET}"
+def red(t): return f"\x1b[1;31m{t}{ANSI_RESET}"
+def green(t): return f"\x1b[1;32m{t}{ANSI_RESET}"
+def pink(t): return f"\x1b[1;35m{t}{ANSI_RESET}"
+def gray(t): return f"\x1b[1;30m{t}{ANSI_RESET}"
+def blue(t): return f"\x1b[1;34m{t}{ANSI_RESET}"
+def yellow(t): return f"\x1b[1;33m{t}{ANSI_RESET}"
+def white(t): return f"\x1b[1;37m{t}{ANSI_RESET}"
 
 class Omikuji(commands.Cog):
     def __init__(self, bot):
@@ -3185,6 +3252,20 @@ class Omikuji(commands.Cog):
             {"name": "【 大 凶 】", "rate": 11, "payout": 0,    "color": red,   "msg": "「あはは！ 最高に無様！ 近寄らないで、不幸が移るわ。」"}
         ]
 
+        # 枠付きの結果表示は運勢ごとに固定なので起動時に組み立てておく
+        for f in self.FORTUNES:
+            frame_color = f["color"]
+            f["frame"] = (
+                f"```ansi\n"
+                f"{frame_color('┏━━━━━━━━━━━━━━━┓')}\n"
+                f"{frame_color('┃')}   {f['name']}   {frame_color('┃')}\n"
+                f"{frame_color('┗━━━━━━━━━━━━━━━┛')}\n"
+                f"```"
+            )
+
+        # 確率は整数%なので、1%刻みの100枠に展開しておけば1回の抽選で引ける
+        self._fortune_slots = tuple(f for f in self.FORTUNES for _ in range(f["rate"]))
+
     @app_commands.command(name="おみくじ", description="ステラちゃんが今日の運勢を占います (1回 300 Stell)")
     async def omikuji(self, interaction: discord.Interaction):
         await interaction.response.defer()
@@ -3198,16 +3279,8 @@ class Omikuji(commands.Cog):
 
             await db.execute("UPDATE accounts SET balance = balance - ? WHERE user_id = ?", (self.cost, user.id))
 
-            rand = random.randint(1, 100)
-            current = 0
-            result = self.FORTUNES[-1]
-            
-            for f in self.FORTUNES:
-                current += f["rate"]
-                if rand <= current:
-                    result = f
-                    break
-            
+            result = random.choice(self._fortune_slots)
+
             payout = result["payout"]
             profit = payout - self.cost
             
@@ -3232,14 +3305,7 @@ class Omikuji(commands.Cog):
         if payout >= 500: embed.color = 0xffd700
         elif payout == 0: embed.color = 0xff0000
 
-        frame_color = result["color"]
-        draw_txt = (
-            f"```ansi\n"
-            f"{frame_color('┏━━━━━━━━━━━━━━━┓')}\n"
-            f"{frame_color('┃')}   {result['name']}   {frame_color('┃')}\n"
-            f"{frame_color('┗━━━━━━━━━━━━━━━┛')}\n"
-            f"```"
-        )
+        draw_txt = result["frame"]
 
         res_str = f"**{payout} Stell** (収支: {profit:+d} Stell)"
         if profit < 0:
@@ -3251,20 +3317,39 @@ class Omikuji(commands.Cog):
         await interaction.followup.send(embed=embed)
         
 # ── Cog: VoiceSystem (改良版) ──
+BOND_MALE_ROLE   = 1471473616406446120
+BOND_FEMALE_ROLE = 1471473863744552992
+
+# 縁ランク: 必要秒数（昇順）と、到達数ごとのランク名（先頭は未到達）
+BOND_RANK_SECONDS = (5*3600, 20*3600, 50*3600, 100*3600, 200*3600)
+BOND_RANKS_SAME = ("", "◆ なんか知ってる人", "◆◆ まあ友達", "◆◆◆ 切っても切れないやつ", "✦ 呪いみたいなもん", "__SELECT__")
+BOND_RANKS_DIFF = ("", "◆ なんか知ってる人", "◆◆ まあ友達", "◆◆◆ 居心地いい人", "✦ うまく説明できない人", "__SELECT__")
+
+def bond_rank(total_sec: int, rank_names: tuple) -> str:
+    return rank_names[bisect.bisect_right(BOND_RANK_SECONDS, total_sec)]
+
+class VoiceUserState:
+    """ユーザーごとの排他ロックと全VC在室の入室時刻（未在室なら None）"""
+    __slots__ = ("lock", "join_time")
+
+    def __init__(self):
+        self.lock      = asyncio.Lock()
+        self.join_time: Optional[datetime.datetime] = None
+
 class VoiceSystem(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.target_vc_ids = set() 
         self.is_ready_processed = False
-        self.locks = {} # ユーザーごとのロック {user_id: asyncio.Lock()}
         self.reward_rate = 50 # 基本レート (Stell/分)
-        self.all_join_times = {} # 全VC追跡用 {user_id: join_time}
+        self.user_states: Dict[int, VoiceUserState] = {} # {user_id: ロック + 全VC追跡用の入室時刻}
         self.vc_members: Dict[int, Dict[int, datetime.datetime]] = {}  # 縁追跡用 {channel_id: {user_id: join_time}}
 
-    def get_lock(self, user_id):
-        if user_id not in self.locks:
-            self.locks[user_id] = asyncio.Lock()
-        return self.locks[user_id]
+    def get_user_state(self, user_id) -> VoiceUserState:
+        vstate = self.user_states.get(user_id)
+        if vstate is None:
+            vstate = self.user_states[user_id] = VoiceUserState()
+        return vstate
 
     async def reload_targets(self):
         try:
@@ -3273,12 +3358,10 @@ class VoiceSystem(commands.Cog):
                 async with db.execute("SELECT channel_id FROM reward_channels") as cursor:
                     rows = await cursor.fetchall()
                 self.target_vc_ids = {row['channel_id'] for row in rows}
-                
-                # 報酬レートの読み込み (設定がなければデフォルト50)
-                async with db.execute("SELECT value FROM server_config WHERE key = 'vc_reward_rate'") as cursor:
-                    row = await cursor.fetchone()
-                    if row: self.reward_rate = int(row['value'])
-            
+
+            # 報酬レートの読み込み (設定がなければデフォルト50)
+            self.reward_rate = self.bot.config.get_int('vc_reward_rate', self.reward_rate)
+
             logger.info(f"Loaded {len(self.target_vc_ids)} reward VCs. Rate: {self.reward_rate}/min")
         except Exception as e:
             logger.error(f"Failed to load voice config: {e}")
@@ -3289,10 +3372,7 @@ class VoiceSystem(commands.Cog):
     async def set_vc_rate(self, interaction: discord.Interaction, amount: int):
         if amount < 0: return await interaction.response.send_message("❌ 0以上にしてください。", ephemeral=True)
         
-        async with self.bot.get_db() as db:
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES ('vc_reward_rate', ?)", (str(amount),))
-            await db.commit()
-        
+        await self.bot.config.set('vc_reward_rate', str(amount))
         self.reward_rate = amount
         await interaction.response.send_message(f"✅ VC報酬レートを **{amount} Stell / 分** に変更しました。\n(インフレ時は下げ、キャンペーン時は上げてください)", ephemeral=True)
 
@@ -3310,8 +3390,10 @@ class VoiceSystem(commands.Cog):
     async def on_voice_state_update(self, member, before, after):
         if member.bot: return
         
+        vstate = self.get_user_state(member.id)
+
         # ロックを取得して同時実行を防ぐ
-        async with self.get_lock(member.id):
+        async with vstate.lock:
             now = datetime.datetime.now()
             was_active, is_now_active = self.is_active(before), self.is_active(after)
 
@@ -3334,7 +3416,7 @@ class VoiceSystem(commands.Cog):
         # ── 全VC在室時間追跡（ランキング用） ──
         # 新しいVCに入った（または別VCに移動した）
         if after.channel and (not before.channel or before.channel.id != after.channel.id):
-            self.all_join_times[member.id] = now
+            vstate.join_time = now
             # 縁追跡: 新チャンネルに入室記録
             ch_id = after.channel.id
             if ch_id not in self.vc_members:
@@ -3354,8 +3436,8 @@ class VoiceSystem(commands.Cog):
             await self._update_bonds(member.id, old_ch_id, now)
             if old_ch_id in self.vc_members:
                 self.vc_members[old_ch_id].pop(member.id, None)
-            if member.id in self.all_join_times:
-                join_time = self.all_join_times.pop(member.id)
+            if vstate.join_time is not None:
+                join_time, vstate.join_time = vstate.join_time, None
                 elapsed = int((now - join_time).total_seconds())
                 if elapsed > 0:
                     month_tag = now.strftime("%Y-%m")
@@ -3455,32 +3537,6 @@ class VoiceSystem(commands.Cog):
         if not others:
             return
 
-        MALE_ROLE   = 1471473616406446120
-        FEMALE_ROLE = 1471473863744552992
-
-        # ランク定義 {(同性か異性か): [(必要秒数, ランク名)]}
-        RANKS_SAME = [
-            (5*3600,   "◆ なんか知ってる人"),
-            (20*3600,  "◆◆ まあ友達"),
-            (50*3600,  "◆◆◆ 切っても切れないやつ"),
-            (100*3600, "✦ 呪いみたいなもん"),
-            (200*3600, "__SELECT__"),
-        ]
-        RANKS_DIFF = [
-            (5*3600,   "◆ なんか知ってる人"),
-            (20*3600,  "◆◆ まあ友達"),
-            (50*3600,  "◆◆◆ 居心地いい人"),
-            (100*3600, "✦ うまく説明できない人"),
-            (200*3600, "__SELECT__"),
-        ]
-
-        def get_rank(total_sec, rank_list):
-            current = ""
-            for threshold, name in rank_list:
-                if total_sec >= threshold:
-                    current = name
-            return current
-
         guild = self.bot.guilds[0] if self.bot.guilds else None
 
         try:
@@ -3518,15 +3574,14 @@ class VoiceSystem(commands.Cog):
                         if ma and mb:
                             a_roles = {r.id for r in ma.roles}
                             b_roles = {r.id for r in mb.roles}
-                            a_male   = MALE_ROLE   in a_roles
-                            a_female = FEMALE_ROLE in a_roles
-                            b_male   = MALE_ROLE   in b_roles
-                            b_female = FEMALE_ROLE in b_roles
+                            a_male   = BOND_MALE_ROLE   in a_roles
+                            a_female = BOND_FEMALE_ROLE in a_roles
+                            b_male   = BOND_MALE_ROLE   in b_roles
+                            b_female = BOND_FEMALE_ROLE in b_roles
                             if (a_male and b_female) or (a_female and b_male):
                                 is_same = False
 
-                    rank_list = RANKS_SAME if is_same else RANKS_DIFF
-                    new_rank  = get_rank(total_sec, rank_list)
+                    new_rank  = bond_rank(total_sec, BOND_RANKS_SAME if is_same else BOND_RANKS_DIFF)
 
                     if new_rank and new_rank != old_rank:
                         await db.execute(
@@ -3639,7 +3694,7 @@ class VoiceHistory(commands.Cog):
     ):
         await interaction.response.defer(ephemeral=True)
 
-        current_month = datetime.datetime.now().strftime("%Y-%m")
+        current_month = current_month_tag()
         is_admin = await interaction.client.is_owner(interaction.user) or any(
             r.id in interaction.client.config.admin_roles and
             interaction.client.config.admin_roles[r.id] in ["SUPREME_GOD", "GODDESS"]
@@ -3734,59 +3789,83 @@ _CFG_DEFAULTS = {
     "cesta_daily_buy_cap": 50,
     "slot_daily_limit":    10,
     "slot_bigwin_cd":      30,
+    "chinchiro_daily_limit": 10,
 }
 
-async def _cfg(bot, key: str) -> int:
-    async with bot.get_db() as db:
-        async with db.execute(
-            "SELECT value FROM server_config WHERE key = ?", (key,)
-        ) as c:
-            row = await c.fetchone()
-    return int(row["value"]) if row else _CFG_DEFAULTS[key]
+# 設定値は ConfigManager のキャッシュから引く（/セスタ設定 も config.set_many で書き込む）
+def _cfg(bot, key: str) -> int:
+    return bot.config.get_int(key, _CFG_DEFAULTS[key])
+
+
+# ── 日次プレイ上限 ──
+# today は呼び出し側で datetime.date.today().isoformat() を1回だけ計算して渡す
+async def claim_daily_slot(db, user_id: int, game: str, today: str, limit: int) -> bool:
+    """
+    上限チェックとカウント加算を1文で行う（引き落としと同じトランザクション内で呼ぶ）
+    上限到達ならカウントは変えずに False（本日の制限解除済みなら常に加算して True）
+    上限0（プレイ禁止）でも制限解除済みなら通すため、初回の挿入も解除の有無で判定する
+    """
+    async with db.execute("""
+        INSERT INTO daily_play_counts (user_id, game, date, count)
+        SELECT ?1, ?2, ?3, 1
+        WHERE ?4 > 0 OR EXISTS (
+            SELECT 1 FROM daily_play_exemptions e
+            WHERE e.user_id = ?1 AND e.game = ?2 AND e.date = ?3
+        )
+        ON CONFLICT(user_id, game, date) DO UPDATE SET count = count + 1
+        WHERE count < ?4 OR EXISTS (
+            SELECT 1 FROM daily_play_exemptions e
+            WHERE e.user_id = excluded.user_id AND e.game = excluded.game AND e.date = excluded.date
+        )
+        RETURNING count
+    """, (user_id, game, today, limit)) as c:
+        row = await c.fetchone()
+    return row is not None
+
 
+# セスタ残高の頻出SQL（sqlite3 の文キャッシュはSQL文字列単位なので、同じ文字列を使い回す）
+_SQL_CESTA_GET_BALANCE = "SELECT balance FROM cesta_wallets WHERE user_id = ?"
+_SQL_CESTA_ADD_BALANCE = """
+    INSERT INTO cesta_wallets (user_id, balance) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
+    RETURNING balance
+"""
+_SQL_CESTA_SUB_BALANCE = "UPDATE cesta_wallets SET balance = balance - ? WHERE user_id = ?"
 
 class CestaSystem(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
 
-    async def get_balance(self, user_id: int) -> int:
-        async with self.bot.get_db() as db:
-            async with db.execute(
-                "SELECT balance FROM cesta_wallets WHERE user_id = ?", (user_id,)
-            ) as c:
-                row = await c.fetchone()
+    async def get_balance(self, user_id: int, db=None) -> int:
+        # db を渡せば開いている接続をそのまま使う
+        if db is None:
+            async with self.bot.get_db() as db:
+                return await self.get_balance(user_id, db)
+        async with db.execute(_SQL_CESTA_GET_BALANCE, (user_id,)) as c:
+            row = await c.fetchone()
         return row["balance"] if row else 0
 
-    async def add_balance(self, db, user_id: int, amount: int):
-        await db.execute("""
-            INSERT INTO cesta_wallets (user_id, balance) VALUES (?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
-        """, (user_id, amount))
+    async def add_balance(self, db, user_id: int, amount: int) -> int:
+        """加算後の残高を返す"""
+        async with db.execute(_SQL_CESTA_ADD_BALANCE, (user_id, amount)) as c:
+            row = await c.fetchone()
+        return row["balance"]
 
     async def sub_balance(self, db, user_id: int, amount: int) -> bool:
         # 同一トランザクション内で残高チェック＋引き落としを行う（競合防止）
-        async with db.execute(
-            "SELECT balance FROM cesta_wallets WHERE user_id = ?", (user_id,)
-        ) as c:
+        async with db.execute(_SQL_CESTA_GET_BALANCE, (user_id,)) as c:
             row = await c.fetchone()
         bal = row["balance"] if row else 0
         if bal < amount:
             return False
-        await db.execute(
-            "UPDATE cesta_wallets SET balance = balance - ? WHERE user_id = ?",
-            (amount, user_id)
-        )
+        await db.execute(_SQL_CESTA_SUB_BALANCE, (amount, user_id))
         return True
 
     @app_commands.command(name="セスタ残高", description="セスタコインの残高を確認します")
     async def cesta_balance(self, interaction: discord.Interaction):
         async with self.bot.get_db() as db:
-            async with db.execute(
-                "SELECT balance FROM cesta_wallets WHERE user_id = ?", (interaction.user.id,)
-            ) as c:
-                row = await c.fetchone()
-            bal = row["balance"] if row else 0
+            bal = await self.get_balance(interaction.user.id, db)
 
             async with db.execute(
                 "SELECT balance FROM accounts WHERE user_id = ?", (interaction.user.id,)
@@ -3794,11 +3873,7 @@ class CestaSystem(commands.Cog):
                 row = await c.fetchone()
             stell_bal = row["balance"] if row else 0
 
-            async with db.execute(
-                "SELECT value FROM server_config WHERE key = 'cesta_rate'"
-            ) as c:
-                row = await c.fetchone()
-            rate = int(row["value"]) if row else 10000
+        rate = _cfg(self.bot, "cesta_rate")
 
         embed = discord.Embed(title="🎰 セスタコイン残高", color=Color.CESTA)
         embed.add_field(name="💜 セスタ", value=f"**{bal:,} セスタ**", inline=True)
@@ -3811,7 +3886,7 @@ class CestaSystem(commands.Cog):
     async def cesta_daily(self, interaction: discord.Interaction):
         today   = datetime.datetime.now().strftime("%Y-%m-%d")
         user_id = interaction.user.id
-        daily_amt = await _cfg(self.bot, "cesta_daily")
+        daily_amt = _cfg(self.bot, "cesta_daily")
 
         async with self.bot.get_db() as db:
             async with db.execute(
@@ -3850,8 +3925,8 @@ class CestaSystem(commands.Cog):
 
         today   = datetime.datetime.now().strftime("%Y-%m-%d")
         user_id = interaction.user.id
-        rate    = await _cfg(self.bot, "cesta_rate")
-        buy_cap = await _cfg(self.bot, "cesta_daily_buy_cap")
+        rate    = _cfg(self.bot, "cesta_rate")
+        buy_cap = _cfg(self.bot, "cesta_daily_buy_cap")
         cost    = amount * rate
 
         async with self.bot.get_db() as db:
@@ -3884,7 +3959,7 @@ class CestaSystem(commands.Cog):
                 ephemeral=True
             )
 
-        month_tag = datetime.datetime.now().strftime("%Y-%m")
+        month_tag = current_month_tag()
         async with self.bot.get_db() as db:
             await db.execute(
                 "UPDATE accounts SET balance = balance - ? WHERE user_id = ?",
@@ -3947,13 +4022,7 @@ class CestaSystem(commands.Cog):
             return await interaction.followup.send(
                 "⚠️ 変更する項目を1つ以上指定してください。", ephemeral=True
             )
-        async with self.bot.get_db() as db:
-            for k, v in changed.items():
-                await db.execute(
-                    "INSERT OR REPLACE INTO server_config (key, value) VALUES (?, ?)",
-                    (k, str(v))
-                )
-            await db.commit()
+        await self.bot.config.set_many({k: str(v) for k, v in changed.items()})
         lines = "\n".join(f"• **{k}** → `{v}`" for k, v in changed.items())
         await interaction.followup.send(f"✅ 設定を更新しました:\n{lines}", ephemeral=True)
 
@@ -4062,12 +4131,6 @@ class CestaSystem(commands.Cog):
 
         owned = {b["badge_id"]: b["granted_at"] for b in badges}
 
-        BADGE_EMOJI = {
-            "入場券":    "🎟️",
-            "道化師の証": "🃏",
-            "座長の印":  "🎪",
-        }
-
         embed = discord.Embed(
             title="🎪 サーカス バッジ",
             color=Color.CESTA
@@ -4155,6 +4218,7 @@ BADGE_EMOJI = {
     "座長の印":  "🎪",
 }
 BADGE_ORDER = ["入場券", "道化師の証", "座長の印"]
+CESTA_ITEM_TYPE_LABEL = {"role": "ロール", "ticket": "商品券"}
 
 class CestaShop(commands.Cog):
 
@@ -4226,7 +4290,7 @@ class CestaShop(commands.Cog):
                 lines = []
                 for item in section_items:
                     lock  = "" if unlocked else "~~"
-                    itype = {"role": "ロール", "ticket": "商品券"}.get(item["item_type"], item["item_type"])
+                    itype = CESTA_ITEM_TYPE_LABEL.get(item["item_type"], item["item_type"])
                     dur   = f"（{item['duration_days']}日間）" if item["duration_days"] > 0 else "（永続）" if item["item_type"] == "role" else ""
                     lines.append(
                         f"{lock}**{item['name']}** {dur}\n"
@@ -4335,7 +4399,7 @@ class CestaShop(commands.Cog):
             title="✅ 購入完了！",
             color=Color.CESTA
         )
-        itype = {"role": "ロール", "ticket": "商品券"}.get(item["item_type"], item["item_type"])
+        itype = CESTA_ITEM_TYPE_LABEL.get(item["item_type"], item["item_type"])
         dur   = f"{item['duration_days']}日間" if item["duration_days"] > 0 else "永続" if item["item_type"] == "role" else ""
         embed.add_field(
             name=item["name"],
@@ -4633,33 +4697,63 @@ class CestaShop(commands.Cog):
 # ================================================================
 
 # ── 取引パネル (View) ──
+# 評価損益の表示枠（緑=含み益 / 赤=含み損）。色付けは固定なので事前に組み立てる
+_PROFIT_ANSI = "```ansi\n" + green("{}") + "```"
+_LOSS_ANSI   = "```ansi\n" + red("{}") + "```"
+
+# 取引パネル/売買の頻出SQL（文キャッシュに確実に当たるよう同じ文字列を使い回す）
+_SQL_STOCK_PANEL_STATE = """
+    SELECT si.total_shares,
+           COALESCE(sh.amount, 0)   AS amount,
+           COALESCE(sh.total_cost, 0) AS total_cost
+    FROM stock_issuers si
+    LEFT JOIN stock_holdings sh ON sh.issuer_id = si.user_id AND sh.user_id = ?
+    WHERE si.user_id = ?
+"""
+_SQL_STOCK_GET_SHARES   = "SELECT total_shares FROM stock_issuers WHERE user_id = ?"
+_SQL_STOCK_ADD_SHARES   = "UPDATE stock_issuers SET total_shares = total_shares + ? WHERE user_id = ? RETURNING total_shares"
+_SQL_STOCK_GET_HOLDING  = "SELECT amount, total_cost FROM stock_holdings WHERE user_id = ? AND issuer_id = ?"
+# 保有は取得総額（整数）で持ち、平均取得単価は読み出し時に割って出す
+_SQL_STOCK_ADD_HOLDING  = """
+    INSERT INTO stock_holdings (user_id, issuer_id, amount, total_cost) VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id, issuer_id) DO UPDATE SET
+        amount     = amount + excluded.amount,
+        total_cost = total_cost + excluded.total_cost
+    RETURNING amount, total_cost
+"""
+_SQL_STOCK_GET_BALANCE  = "SELECT balance FROM accounts WHERE user_id = ?"
+_SQL_STOCK_ADD_BALANCE  = "UPDATE accounts SET balance = balance + ? WHERE user_id = ?"
+_SQL_STOCK_INSERT_TX    = "INSERT INTO transactions (sender_id, receiver_id, amount, type, description, month_tag) VALUES (?, ?, ?, ?, ?, ?)"
+
 class StockControlView(discord.ui.View):
     def __init__(self, cog, target_user: discord.Member):
         super().__init__(timeout=300)
         self.cog = cog
         self.target = target_user
+        # ボタンの二度押しで売買や読み込みが重ならないよう、このパネルの処理は1つずつ行う
+        self._lock = asyncio.Lock()
 
     async def update_embed(self, interaction: discord.Interaction):
+        # 直前（1秒以内）に作った同じパネルがあればそれを返す
+        cached = self.cog.get_cached_panel(self.target.id, interaction.user.id)
+        if cached:
+            return cached
+
         # 1. DBから最新情報を取得
-        star_role_id = None
-        async with self.cog.bot.get_db() as db:
-            # スターロールIDの確認
-            async with db.execute("SELECT value FROM market_config WHERE key = 'star_role_id'") as c:
-                row = await c.fetchone()
-                if row: star_role_id = int(row['value'])
+        star_role_id = await self.cog.get_config_id('star_role_id')
 
-            # 発行株数の確認
-            async with db.execute("SELECT total_shares FROM stock_issuers WHERE user_id = ?", (self.target.id,)) as c:
+        # 発行株数と自分の保有状況を1回の問い合わせでまとめて取る
+        async with self.cog.bot.get_db() as db:
+            async with db.execute(_SQL_STOCK_PANEL_STATE, (interaction.user.id, self.target.id)) as c:
                 row = await c.fetchone()
-                if not row: return None 
-                shares = row['total_shares']
-            
-            # 自分の保有状況の確認
-            async with db.execute("SELECT amount, avg_cost FROM stock_holdings WHERE user_id = ? AND issuer_id = ?", (interaction.user.id, self.target.id)) as c:
-                holding = await c.fetchone()
-                my_amount = holding['amount'] if holding else 0
-                my_avg = holding['avg_cost'] if holding else 0
+        if not row: return None
+        my_amount = row['amount']
+        my_avg = row['total_cost'] / my_amount if my_amount else 0
+        embed = self.build_embed(star_role_id, row['total_shares'], my_amount, my_avg)
+        self.cog.set_cached_panel(self.target.id, interaction.user.id, embed)
+        return embed
 
+    def build_embed(self, star_role_id, shares, my_amount, my_avg):
         # 2. スター判定（ターゲットがスターロールを持っているか？）
         is_star = False
         if star_role_id:
@@ -4706,11 +4800,8 @@ class StockControlView(discord.ui.View):
         
         # 損益表示（スターで色が固定されても、損益は文字色で見やすくする）
         profit_str = f"{sign}{int(profit):,} S"
-        if profit >= 0:
-            val_str = f"```ansi\n\u001b[1;32m{profit_str}\u001b[0m```" # 緑
-        else:
-            val_str = f"```ansi\n\u001b[1;31m{profit_str}\u001b[0m```" # 赤
-            
+        val_str = (_PROFIT_ANSI if profit >= 0 else _LOSS_ANSI).format(profit_str)
+
         embed.add_field(name="📊 評価損益", value=val_str, inline=True)
         
         if is_star:
@@ -4730,32 +4821,41 @@ class StockControlView(discord.ui.View):
 
     @discord.ui.button(label="全売却", style=discord.ButtonStyle.danger, emoji="💥", row=1)
     async def sell_all(self, interaction, button):
-        async with self.cog.bot.get_db() as db:
-            async with db.execute("SELECT amount FROM stock_holdings WHERE user_id = ? AND issuer_id = ?", (interaction.user.id, self.target.id)) as c:
-                row = await c.fetchone()
-                amount = row['amount'] if row else 0
-        if amount > 0: await self._trade(interaction, "sell", amount)
-        else: await interaction.response.send_message("株を持っていません。", ephemeral=True)
+        # 保有数の確認は internal_sell 側の読み取りで兼ねる（None = 全株）
+        await self._trade(interaction, "sell", None)
 
     @discord.ui.button(label="更新", style=discord.ButtonStyle.secondary, emoji="🔄", row=1)
     async def refresh(self, interaction, button):
-        new_embed = await self.update_embed(interaction)
-        if new_embed: await interaction.response.edit_message(embed=new_embed, view=self)
+        # 先に応答だけ返しておき、DB待ちが3秒を超えても「インタラクション失敗」にしない
+        await interaction.response.defer()
+        async with self._lock:
+            new_embed = await self.update_embed(interaction)
+            if new_embed: await interaction.edit_original_response(embed=new_embed, view=self)
 
     async def _trade(self, interaction, type, amount):
-        if type == "buy": msg, success = await self.cog.internal_buy(interaction.user, self.target, amount)
-        else: msg, success = await self.cog.internal_sell(interaction.user, self.target, amount)
+        # ロック待ち・DB待ちの前に応答しておく（混雑時は「更新が遅い」だけで済む）
+        await interaction.response.defer()
+        async with self._lock:
+            # 取引後の (発行数, 保有数, 平均取得単価) は売買処理が返すので、パネル用に読み直さない
+            if type == "buy": msg, success, state = await self.cog.internal_buy(interaction.user, self.target, amount)
+            else: msg, success, state = await self.cog.internal_sell(interaction.user, self.target, amount)
         
-        if success:
-            new_embed = await self.update_embed(interaction)
-            await interaction.response.edit_message(embed=new_embed, view=self)
-            await interaction.followup.send(msg, ephemeral=True)
-        else:
-            await interaction.response.send_message(msg, ephemeral=True)
+            if success:
+                star_role_id = await self.cog.get_config_id('star_role_id')
+                new_embed = self.build_embed(star_role_id, *state)
+                # 取引で内容が変わったので、キャッシュは取引直後の状態で上書きする
+                self.cog.set_cached_panel(self.target.id, interaction.user.id, new_embed)
+                await interaction.edit_original_response(embed=new_embed, view=self)
+                await interaction.followup.send(msg, ephemeral=True)
+            else:
+                await interaction.followup.send(msg, ephemeral=True)
 
 
 # ── 本体 (Cog) ──
 class HumanStockMarket(commands.Cog):
+
+    PANEL_CACHE_SECONDS = 1.0
+
     def __init__(self, bot):
         self.bot = bot
         # ── 市場設定 ──
@@ -4763,11 +4863,54 @@ class HumanStockMarket(commands.Cog):
         self.slope = 20             # 価格感応度（1株ごとの値上がり幅）
         self.trading_fee = 0.10     # 手数料10%
         self.issuer_fee = 0.05      # 発行者への還元5%
-        
-        self.promotion_cycle_task.start() # 昇格審査タスクを開始
+
+        # market_config（ロールID・ログ先など）は設定コマンドでしか変わらないのでメモリに置く
+        self._config_cache: Dict[str, str] = {}
+        self._config_loaded = False
+
+        # 取引パネルの連打対策: {(銘柄ID, 閲覧者ID): (期限 monotonic, Embed)}
+        self._panel_cache: Dict[tuple, tuple] = {}
+
+        self._promotion_timer: Optional[asyncio.Task] = None
+
+    async def cog_load(self):
+        # テーブル確認は起動時に1回だけ
+        await self.init_market_db()
+        self._promotion_timer = asyncio.create_task(self.promotion_timer()) # 昇格審査タイマーを開始
 
     def cog_unload(self):
-        self.promotion_cycle_task.cancel()
+        if self._promotion_timer:
+            self._promotion_timer.cancel()
+
+    async def get_config(self, key: str) -> Optional[str]:
+        if not self._config_loaded:
+            async with self.bot.get_db() as db:
+                async with db.execute("SELECT key, value FROM market_config") as c:
+                    async for row in c:
+                        self._config_cache.setdefault(row['key'], row['value'])
+            self._config_loaded = True
+        return self._config_cache.get(key)
+
+    async def get_config_id(self, key: str) -> Optional[int]:
+        value = await self.get_config(key)
+        return int(value) if value else None
+
+    def get_cached_panel(self, target_id: int, user_id: int) -> Optional[discord.Embed]:
+        entry = self._panel_cache.get((target_id, user_id))
+        if entry is None:
+            return None
+        if entry[0] > time.monotonic():
+            return entry[1]
+        del self._panel_cache[(target_id, user_id)]
+        return None
+
+    def set_cached_panel(self, target_id: int, user_id: int, embed: discord.Embed):
+        now = time.monotonic()
+        # 期限切れのエントリを掃除して辞書が増え続けないようにする
+        expired = [k for k, (deadline, _) in self._panel_cache.items() if deadline <= now]
+        for k in expired:
+            del self._panel_cache[k]
+        self._panel_cache[(target_id, user_id)] = (now + self.PANEL_CACHE_SECONDS, embed)
 
     # 価格計算式（ボンディングカーブ）
     def calculate_price(self, shares):
@@ -4776,47 +4919,61 @@ class HumanStockMarket(commands.Cog):
     async def init_market_db(self):
         async with self.bot.get_db() as db:
             await db.execute("CREATE TABLE IF NOT EXISTS stock_issuers (user_id INTEGER PRIMARY KEY, total_shares INTEGER DEFAULT 0, is_listed INTEGER DEFAULT 1)")
-            await db.execute("CREATE TABLE IF NOT EXISTS stock_holdings (user_id INTEGER, issuer_id INTEGER, amount INTEGER, avg_cost REAL, PRIMARY KEY (user_id, issuer_id))")
+            await db.execute("CREATE TABLE IF NOT EXISTS stock_holdings (user_id INTEGER, issuer_id INTEGER, amount INTEGER, total_cost INTEGER DEFAULT 0, PRIMARY KEY (user_id, issuer_id))")
+            # 旧形式（avg_cost REAL）のテーブルには取得総額の列を足して移行する
+            async with db.execute("PRAGMA table_info(stock_holdings)") as c:
+                cols = {r['name'] async for r in c}
+            if 'total_cost' not in cols:
+                await db.execute("ALTER TABLE stock_holdings ADD COLUMN total_cost INTEGER DEFAULT 0")
+                await db.execute("UPDATE stock_holdings SET total_cost = CAST(amount * avg_cost AS INTEGER)")
             await db.execute("CREATE TABLE IF NOT EXISTS market_config (key TEXT PRIMARY KEY, value TEXT)")
+            # ランキング/昇格審査の「上場中を発行数順」をソートなしで読めるようにする
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_issuers_shares_desc ON stock_issuers (total_shares DESC) WHERE is_listed = 1")
             await db.commit()
 
     # ── 昇格・入れ替えシステム (2週間ごとのランキング集計) ──
-    @tasks.loop(hours=1) # 1時間ごとにチェック
-    async def promotion_cycle_task(self):
-        await self.bot.wait_until_ready()
-        now = datetime.datetime.now()
-        
+    async def set_next_promotion(self, next_date: datetime.datetime):
         async with self.bot.get_db() as db:
-            # 次回の審査日時を取得
-            async with db.execute("SELECT value FROM market_config WHERE key = 'next_promotion_date'") as c:
-                row = await c.fetchone()
-                if row:
-                    next_date = datetime.datetime.fromisoformat(row['value'])
+            await db.execute("INSERT OR REPLACE INTO market_config (key, value) VALUES ('next_promotion_date', ?)", (next_date.isoformat(),))
+            await db.commit()
+        self._config_cache['next_promotion_date'] = next_date.isoformat()
+
+    async def promotion_timer(self):
+        # 1時間ごとにDBを見に行くのではなく、次回審査日時まで眠って1回だけ起きる
+        await self.bot.wait_until_ready()
+        while True:
+            # どこで失敗してもタスクを終わらせず、ログを残して1時間後にやり直す
+            try:
+                value = await self.get_config('next_promotion_date')
+                if value:
+                    next_date = datetime.datetime.fromisoformat(value)
                 else:
                     # 設定がない場合は現在時刻から2週間後をセット
-                    next_date = now + datetime.timedelta(weeks=2)
-                    await db.execute("INSERT OR REPLACE INTO market_config (key, value) VALUES ('next_promotion_date', ?)", (next_date.isoformat(),))
-                    await db.commit()
-                    return # 初回セット時はスキップ
-
-        # 審査時刻を過ぎていたら実行
-        if now >= next_date:
-            await self.execute_promotion(now)
+                    next_date = datetime.datetime.now() + datetime.timedelta(weeks=2)
+                    await self.set_next_promotion(next_date)
+
+                delay = (next_date - datetime.datetime.now()).total_seconds()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                # 審査後に次回日程（2週間後）が書き込まれるので、ループ先頭で読み直す
+                await self.execute_promotion(datetime.datetime.now())
+                if await self.get_config('next_promotion_date') == next_date.isoformat():
+                    # ロール未設定などで審査が行われなかった場合は1時間後に再試行
+                    await asyncio.sleep(3600)
+            except Exception as e:
+                logger.error(f"Promotion Error: {e}")
+                await asyncio.sleep(3600)
 
     async def execute_promotion(self, now):
         guild = self.bot.guilds[0] # メインサーバーを想定
-        cast_role_id = None
-        star_role_id = None
-        log_ch_id = None
 
         # 設定読み込み
+        cast_role_id = await self.get_config_id('cast_role_id')
+        star_role_id = await self.get_config_id('star_role_id')
+        log_ch_id    = await self.get_config_id('promotion_log_id')
+
         async with self.bot.get_db() as db:
-            async with db.execute("SELECT key, value FROM market_config") as c:
-                async for row in c:
-                    if row['key'] == 'cast_role_id': cast_role_id = int(row['value'])
-                    elif row['key'] == 'star_role_id': star_role_id = int(row['value'])
-                    elif row['key'] == 'promotion_log_id': log_ch_id = int(row['value'])
-            
             # ランキング集計（株価が高い順 = 発行数が多い順）
             async with db.execute("SELECT user_id, total_shares FROM stock_issuers WHERE is_listed=1 ORDER BY total_shares DESC") as c:
                 rankings = await c.fetchall()
@@ -4831,8 +4988,6 @@ class HumanStockMarket(commands.Cog):
 
         # 上位4名を特定
         top_4_ids = []
-        promoted_members = []
-        demoted_members = []
 
         # ランキング上位からループして、キャストロールを持っている人を探す
         for row in rankings:
@@ -4842,30 +4997,25 @@ class HumanStockMarket(commands.Cog):
             if member and cast_role in member.roles: # キャストロール所持者のみ対象
                 top_4_ids.append(member.id)
 
-        # 1. スターロールの付与と剥奪処理
-        # 現在スターロールを持っている全員をチェック
-        for member in star_role.members:
-            if member.id not in top_4_ids:
-                try:
-                    await member.remove_roles(star_role, reason="株価ランキング圏外による降格")
-                    demoted_members.append(member.display_name)
-                except: pass
-        
-        # 新トップ4にスターロール付与
-        for uid in top_4_ids:
-            member = guild.get_member(uid)
-            if member:
-                if star_role not in member.roles:
-                    try:
-                        await member.add_roles(star_role, reason="株価ランキングTop4入り")
-                        promoted_members.append(member.display_name)
-                    except: pass
+        # 1. スターロールの付与と剥奪処理（HTTPは並行で投げる）
+        # 現在スターロールを持っている全員のうち圏外の人から剥奪
+        to_demote = [m for m in star_role.members if m.id not in top_4_ids]
+        # 新トップ4のうち未所持の人に付与
+        to_promote = [
+            m for m in (guild.get_member(uid) for uid in top_4_ids)
+            if m and star_role not in m.roles
+        ]
+        results = await asyncio.gather(
+            *(m.remove_roles(star_role, reason="株価ランキング圏外による降格") for m in to_demote),
+            *(m.add_roles(star_role, reason="株価ランキングTop4入り") for m in to_promote),
+            return_exceptions=True
+        )
+        demoted_members  = [m.display_name for m, r in zip(to_demote, results) if not isinstance(r, Exception)]
+        promoted_members = [m.display_name for m, r in zip(to_promote, results[len(to_demote):]) if not isinstance(r, Exception)]
 
         # 次回の日程を更新 (2週間後)
         next_due = now + datetime.timedelta(weeks=2)
-        async with self.bot.get_db() as db:
-            await db.execute("INSERT OR REPLACE INTO market_config (key, value) VALUES ('next_promotion_date', ?)", (next_due.isoformat(),))
-            await db.commit()
+        await self.set_next_promotion(next_due)
 
         # ログ・通知送信
         if log_ch_id:
@@ -4873,16 +5023,13 @@ class HumanStockMarket(commands.Cog):
             if channel:
                 embed = discord.Embed(title="👑 キャスト選抜総選挙 結果発表", description="株価ランキングによるスター入れ替えが行われました。", color=Color.STELL)
                 
+                # 株価取得用
+                share_map = {r['user_id']: r['total_shares'] for r in rankings}
                 top_text = ""
                 for i, uid in enumerate(top_4_ids):
                     m = guild.get_member(uid)
                     name = m.display_name if m else "Unknown"
-                    share_val = 0
-                    # 株価取得用
-                    for r in rankings:
-                        if r['user_id'] == uid:
-                            share_val = self.calculate_price(r['total_shares'])
-                            break
+                    share_val = self.calculate_price(share_map[uid]) if uid in share_map else 0
                     top_text += f"**{i+1}位**: {name} (株価: {share_val:,} S)\n"
                 
                 if not top_text: top_text = "該当者なし"
@@ -4900,89 +5047,95 @@ class HumanStockMarket(commands.Cog):
 
     # ── 内部処理: 購入 ──
     async def internal_buy(self, buyer, target, amount):
-        if buyer.id == target.id: return ("❌ 自己売買は禁止です。", False)
+        if buyer.id == target.id: return ("❌ 自己売買は禁止です。", False, None)
         
         async with self.bot.get_db() as db:
-            async with db.execute("SELECT total_shares FROM stock_issuers WHERE user_id = ?", (target.id,)) as c:
-                row = await c.fetchone()
-                if not row: return ("❌ 上場していません。", False)
-                shares = row['total_shares']
+            # 価格・残高の確認から書き込みまでを1つの書き込みトランザクションで行う
+            # （途中で return した場合は接続の返却時にロールバックされる）
+            try:
+                await db.execute("BEGIN IMMEDIATE")
+                async with db.execute(_SQL_STOCK_GET_SHARES, (target.id,)) as c:
+                    row = await c.fetchone()
+                    if not row: return ("❌ 上場していません。", False, None)
+                    shares = row['total_shares']
 
-            # 価格計算
-            unit_price = self.calculate_price(shares)
+                # 価格計算
+                unit_price = self.calculate_price(shares)
             
-            # 購入処理
-            subtotal = unit_price * amount
-            fee = int(subtotal * self.trading_fee)
-            bonus = int(subtotal * self.issuer_fee)
-            total = subtotal + fee + bonus
+                # 購入処理
+                subtotal = unit_price * amount
+                fee = int(subtotal * self.trading_fee)
+                bonus = int(subtotal * self.issuer_fee)
+                total = subtotal + fee + bonus
 
-            async with db.execute("SELECT balance FROM accounts WHERE user_id = ?", (buyer.id,)) as c:
-                bal = await c.fetchone()
-                if not bal or bal['balance'] < total: return (f"❌ 資金不足 (必要: {total:,} S)", False)
+                async with db.execute(_SQL_STOCK_GET_BALANCE, (buyer.id,)) as c:
+                    bal = await c.fetchone()
+                    if not bal or bal['balance'] < total: return (f"❌ 資金不足 (必要: {total:,} S)", False, None)
 
-            try:
                 # 資産移動
-                await db.execute("UPDATE accounts SET balance = balance - ? WHERE user_id = ?", (total, buyer.id))
-                await db.execute("UPDATE accounts SET balance = balance + ? WHERE user_id = ?", (bonus, target.id)) # 発行者へ還元
+                # 購入者から引き落とし / 発行者へ還元
+                await db.executemany(_SQL_STOCK_ADD_BALANCE, [(-total, buyer.id), (bonus, target.id)])
                 
-                # 保有データ更新
-                async with db.execute("SELECT amount, avg_cost FROM stock_holdings WHERE user_id = ? AND issuer_id = ?", (buyer.id, target.id)) as c:
+                # 保有データ更新（取得総額に足し込むだけ。平均単価は表示時に算出）
+                async with db.execute(_SQL_STOCK_ADD_HOLDING, (buyer.id, target.id, amount, subtotal)) as c:
                     h = await c.fetchone()
-                
-                if h:
-                    new_n = h['amount'] + amount
-                    # 平均取得単価の更新
-                    new_avg = ((h['amount'] * h['avg_cost']) + subtotal) / new_n
-                    await db.execute("UPDATE stock_holdings SET amount = ?, avg_cost = ? WHERE user_id = ? AND issuer_id = ?", (new_n, new_avg, buyer.id, target.id))
-                else:
-                    await db.execute("INSERT INTO stock_holdings (user_id, issuer_id, amount, avg_cost) VALUES (?, ?, ?, ?)", (buyer.id, target.id, amount, unit_price))
+                new_n = h['amount']
+                new_avg = h['total_cost'] / new_n
                 
                 # 発行数増加（これにより次の人の購入価格が上がる）
-                await db.execute("UPDATE stock_issuers SET total_shares = total_shares + ? WHERE user_id = ?", (amount, target.id))
+                async with db.execute(_SQL_STOCK_ADD_SHARES, (amount, target.id)) as c:
+                    new_shares = (await c.fetchone())['total_shares']
                 
-                month = datetime.datetime.now().strftime("%Y-%m")
-                await db.execute("INSERT INTO transactions (sender_id, receiver_id, amount, type, description, month_tag) VALUES (?, ?, ?, 'STOCK_BUY', ?, ?)",
-                                 (buyer.id, 0, total, f"株購入: {target.display_name}", month))
+                month = current_month_tag()
+                await db.execute(_SQL_STOCK_INSERT_TX, (buyer.id, 0, total, 'STOCK_BUY', f"株購入: {target.display_name}", month))
                 await db.commit()
-                return (f"✅ 購入成功: {target.display_name} x{amount}株 (単価: {unit_price:,} S)", True)
+                return (f"✅ 購入成功: {target.display_name} x{amount}株 (単価: {unit_price:,} S)", True, (new_shares, new_n, new_avg))
             except Exception as e:
                 await db.rollback()
-                return (f"エラー: {e}", False)
+                return (f"エラー: {e}", False, None)
 
     # ── 内部処理: 売却 ──
-    async def internal_sell(self, seller, target, amount):
+    async def internal_sell(self, seller, target, amount: Optional[int]):
         async with self.bot.get_db() as db:
-            async with db.execute("SELECT total_shares FROM stock_issuers WHERE user_id = ?", (target.id,)) as c:
-                row = await c.fetchone()
-                if not row: return ("❌ 上場していません。", False)
-                shares = row['total_shares']
-
-            async with db.execute("SELECT amount, avg_cost FROM stock_holdings WHERE user_id = ? AND issuer_id = ?", (seller.id, target.id)) as c:
-                h = await c.fetchone()
-                if not h or h['amount'] < amount: return ("❌ 保有数不足", False)
+            # 保有数の確認から書き込みまでを1つの書き込みトランザクションで行う
+            try:
+                await db.execute("BEGIN IMMEDIATE")
+                async with db.execute(_SQL_STOCK_GET_SHARES, (target.id,)) as c:
+                    row = await c.fetchone()
+                    if not row: return ("❌ 上場していません。", False, None)
+                    shares = row['total_shares']
 
-            # 現在価格で売却（売るときは少し安くなる＝スプレッド要素として、base_price計算を現在発行数ベースで行う）
-            unit_price = self.calculate_price(shares)
-            revenue = unit_price * amount
+                async with db.execute(_SQL_STOCK_GET_HOLDING, (seller.id, target.id)) as c:
+                    h = await c.fetchone()
+                if amount is None:
+                    # 全売却
+                    if not h or h['amount'] <= 0: return ("株を持っていません。", False, None)
+                    amount = h['amount']
+                elif not h or h['amount'] < amount: return ("❌ 保有数不足", False, None)
+
+                # 現在価格で売却（売るときは少し安くなる＝スプレッド要素として、base_price計算を現在発行数ベースで行う）
+                unit_price = self.calculate_price(shares)
+                revenue = unit_price * amount
             
-            try:
                 new_n = h['amount'] - amount
                 if new_n == 0: await db.execute("DELETE FROM stock_holdings WHERE user_id = ? AND issuer_id = ?", (seller.id, target.id))
-                else: await db.execute("UPDATE stock_holdings SET amount = ? WHERE user_id = ? AND issuer_id = ?", (new_n, seller.id, target.id))
+                else:
+                    # 取得総額は売った割合だけ整数で減らす（平均単価は据え置き）
+                    new_cost = h['total_cost'] * new_n // h['amount']
+                    await db.execute("UPDATE stock_holdings SET amount = ?, total_cost = ? WHERE user_id = ? AND issuer_id = ?", (new_n, new_cost, seller.id, target.id))
                 
-                await db.execute("UPDATE accounts SET balance = balance + ? WHERE user_id = ?", (revenue, seller.id))
+                await db.execute(_SQL_STOCK_ADD_BALANCE, (revenue, seller.id))
                 # 発行数を減らす（価格が下がる）
-                await db.execute("UPDATE stock_issuers SET total_shares = total_shares - ? WHERE user_id = ?", (amount, target.id))
+                async with db.execute(_SQL_STOCK_ADD_SHARES, (-amount, target.id)) as c:
+                    new_shares = (await c.fetchone())['total_shares']
                 
-                month = datetime.datetime.now().strftime("%Y-%m")
-                await db.execute("INSERT INTO transactions (sender_id, receiver_id, amount, type, description, month_tag) VALUES (0, ?, ?, 'STOCK_SELL', ?, ?)",
-                                 (seller.id, revenue, f"株売却: {target.display_name}", month))
+                month = current_month_tag()
+                await db.execute(_SQL_STOCK_INSERT_TX, (0, seller.id, revenue, 'STOCK_SELL', f"株売却: {target.display_name}", month))
                 await db.commit()
-                return (f"📉 売却成功: {revenue:,} S 受取", True)
+                return (f"📉 売却成功: {revenue:,} S 受取", True, (new_shares, new_n, new_cost / new_n if new_n else 0))
             except Exception as e:
                 await db.rollback()
-                return (f"エラー: {e}", False)
+                return (f"エラー: {e}", False, None)
 
     # ── コマンド類 ──
 
@@ -4993,6 +5146,7 @@ class HumanStockMarket(commands.Cog):
         async with self.bot.get_db() as db:
             await db.execute("INSERT OR REPLACE INTO market_config (key, value) VALUES ('cast_role_id', ?)", (str(role.id),))
             await db.commit()
+        self._config_cache['cast_role_id'] = str(role.id)
         await interaction.followup.send(f"✅ 上場可能ロールを {role.mention} に設定しました。", ephemeral=True)
 
     @app_commands.command(name="株_スター設定", description="【管理者】ランキング上位に付与する『スター』ロールを設定します")
@@ -5002,6 +5156,7 @@ class HumanStockMarket(commands.Cog):
         async with self.bot.get_db() as db:
             await db.execute("INSERT OR REPLACE INTO market_config (key, value) VALUES ('star_role_id', ?)", (str(role.id),))
             await db.commit()
+        self._config_cache['star_role_id'] = str(role.id)
         await interaction.followup.send(f"✅ 上位報酬ロールを {role.mention} に設定しました。", ephemeral=True)
 
     @app_commands.command(name="株_結果ログ設定", description="【管理者】昇格・降格の結果を発表するチャンネルを設定します")
@@ -5011,19 +5166,15 @@ class HumanStockMarket(commands.Cog):
         async with self.bot.get_db() as db:
             await db.execute("INSERT OR REPLACE INTO market_config (key, value) VALUES ('promotion_log_id', ?)", (str(channel.id),))
             await db.commit()
+        self._config_cache['promotion_log_id'] = str(channel.id)
         await interaction.followup.send(f"✅ 結果発表先を {channel.mention} に設定しました。", ephemeral=True)
 
     @app_commands.command(name="株_上場", description="自分の株を上場します（キャスト限定）")
     async def ipo(self, interaction):
-        await self.init_market_db()
         user = interaction.user
 
         # ロールチェック
-        cast_role_id = None
-        async with self.bot.get_db() as db:
-            async with db.execute("SELECT value FROM market_config WHERE key = 'cast_role_id'") as c:
-                row = await c.fetchone()
-                if row: cast_role_id = int(row['value'])
+        cast_role_id = await self.get_config_id('cast_role_id')
         
         if not cast_role_id:
             return await interaction.response.send_message("❌ システムエラー: キャストロールが未設定です。管理者に連絡してください。", ephemeral=True)
@@ -5042,7 +5193,6 @@ class HumanStockMarket(commands.Cog):
 
     @app_commands.command(name="株_取引パネル", description="株の売買パネルを開きます")
     async def open_panel(self, interaction: discord.Interaction, target: discord.Member):
-        await self.init_market_db()
         view = StockControlView(self, target)
         embed = await view.update_embed(interaction)
         if embed: await interaction.response.send_message(embed=embed, view=view)
@@ -5050,40 +5200,37 @@ class HumanStockMarket(commands.Cog):
 
     @app_commands.command(name="株_ランキング", description="現在の株価ランキングと次回の審査日を表示します")
     async def ranking(self, interaction: discord.Interaction):
-        await self.init_market_db()
         await interaction.response.defer()
         
         next_date_str = "未定"
-        async with self.bot.get_db() as db:
-            async with db.execute("SELECT user_id, total_shares FROM stock_issuers WHERE is_listed=1") as c: rows = await c.fetchall()
-            async with db.execute("SELECT value FROM market_config WHERE key = 'next_promotion_date'") as c:
-                row = await c.fetchone()
-                if row:
-                    dt = datetime.datetime.fromisoformat(row['value'])
-                    next_date_str = dt.strftime("%m/%d %H:%M")
+        value = await self.get_config('next_promotion_date')
+        if value:
+            next_date_str = datetime.datetime.fromisoformat(value).strftime("%m/%d %H:%M")
 
-        data = []
-        for r in rows:
-            p = self.calculate_price(r['total_shares'])
-            m = interaction.guild.get_member(r['user_id'])
-            # 退室したメンバーなどは除外
-            if not m: continue
-            
-            name = m.display_name
-            data.append((name, p, r['total_shares']))
-        
-        # 株価順（=発行数順）にソート
-        data.sort(key=lambda x: x[1], reverse=True)
-        
         desc = f"📅 **次回審査: {next_date_str}**\n上位4名が『スター』に昇格します。\n\n"
-        
-        for i, d in enumerate(data[:10]):
-            rank_icon = "👑" if i < 4 else f"{i+1}."
-            bold = "**" if i < 4 else ""
-            line = f"{rank_icon} {bold}{d[0]}{bold}: 株価 {d[1]:,} S (流通: {d[2]}株)\n"
-            desc += line
+
+        async with self.bot.get_db() as db:
+            # 表示は上位10名まで。それ以降は在籍者の人数だけ数える（全件をリストに溜めずに流し読み）
+            shown = others = 0
+            # 株価順（=発行数順）の並べ替えはSQL側で行う
+            async with db.execute("SELECT user_id, total_shares FROM stock_issuers WHERE is_listed=1 ORDER BY total_shares DESC") as c:
+                async for r in c:
+                    m = interaction.guild.get_member(r['user_id'])
+                    # 退室したメンバーなどは除外
+                    if not m: continue
+                    if shown >= 10:
+                        others += 1
+                        continue
+
+                    i = shown
+                    shown += 1
+                    p = self.calculate_price(r['total_shares'])
+                    rank_icon = "👑" if i < 4 else f"{i+1}."
+                    bold = "**" if i < 4 else ""
+                    line = f"{rank_icon} {bold}{m.display_name}{bold}: 株価 {p:,} S (流通: {r['total_shares']}株)\n"
+                    desc += line
             
-        if len(data) > 10: desc += f"\n...他 {len(data)-10} 名"
+        if others: desc += f"\n...他 {others} 名"
 
         embed = discord.Embed(title="📊 キャスト株価ランキング", description=desc, color=Color.STELL)
         embed.set_footer(text="株を買うと価格が上がり、売ると下がります。推しをスターに押し上げよう！")
@@ -5100,47 +5247,61 @@ class ServerStats(commands.Cog):
         self.daily_log_task.cancel()
 
     # ── ジニ係数計算 ──────────────────────────────────────
-    def _calc_gini(self, balances: list) -> float:
-        if not balances or sum(balances) == 0:
+    def _calc_gini(self, s: list, total: int) -> float:
+        """s は昇順ソート済みの残高、total はその合計"""
+        if not s or total == 0:
             return 0.0
-        s = sorted(balances)
         n = len(s)
+        # Σ(i+1)·s[i] = (n+1)·total − Σ累積和（ループをCレベルの accumulate/sum に任せる）
+        weighted = (n + 1) * total - sum(itertools.accumulate(s))
+        return (2 * weighted / (n * total)) - (n + 1) / n
+
+    def _summarize_balances(self, balances: list):
+        """(人数, 合計, 中央値, ジニ係数) を返す。市民数に比例して重いのでスレッドで呼ぶ
+        ソート済みリストは持ち帰らず、レポートに要る要約値だけを返す"""
+        s = sorted(balances)
+        count = len(s)
         total = sum(s)
-        return (2 * sum((i + 1) * v for i, v in enumerate(s)) / (n * total)) - (n + 1) / n
+        median = s[count // 2] if s else 0
+        return count, total, median, self._calc_gini(s, total)
 
 # ── 市民の残高リストを取得 ─────────────────────────────
     async def _get_citizen_balances(self) -> list[int]:
         guild = self.bot.guilds[0]
         if not guild.chunked:
             await guild.chunk()
-        member_map = {m.id: m for m in guild.members}
 
-        async with self.bot.get_db() as db:
-            async with db.execute(
-                "SELECT value FROM server_config WHERE key = 'citizen_role_id'"
-            ) as c:
-                row = await c.fetchone()
-            citizen_role_id = int(row["value"]) if row else None
+        citizen_role_id = self.bot.config.get_int('citizen_role_id')
 
-            god_role_ids = {
-                r_id for r_id, level in self.bot.config.admin_roles.items()
-                if level == "SUPREME_GOD"
-            }
+        god_role_ids = {
+            r_id for r_id, level in self.bot.config.admin_roles.items()
+            if level == "SUPREME_GOD"
+        }
 
-            async with db.execute("SELECT user_id, balance FROM accounts WHERE user_id != 0") as c:
-                all_accounts = await c.fetchall()
+        # ロール所持者は口座ごとに roles を走査せず、ロール側から ID 集合を作って引く
+        god_ids = {
+            m.id for r_id in god_role_ids
+            if (role := guild.get_role(r_id)) for m in role.members
+        }
+        citizen_ids = None
+        if citizen_role_id:
+            citizen_role = guild.get_role(citizen_role_id)
+            citizen_ids = {m.id for m in citizen_role.members} if citizen_role else set()
 
+        # 口座は全件をリストに溜めず、1行ずつ読みながら振り分ける
         balances = []
-        for row in all_accounts:
-            uid, bal = row["user_id"], row["balance"]
-            member = member_map.get(uid)
-            if not member or member.bot:
-                continue
-            if any(r.id in god_role_ids for r in member.roles):
-                continue
-            if citizen_role_id and not any(r.id == citizen_role_id for r in member.roles):
-                continue
-            balances.append(bal)
+        async with self.bot.get_db() as db:
+            async with db.execute("SELECT user_id, balance FROM accounts WHERE user_id != 0") as c:
+                async for row in c:
+                    uid, bal = row["user_id"], row["balance"]
+                    member = guild.get_member(uid)
+                    if not member or member.bot:
+                        continue
+                    if uid in god_ids:
+                        continue
+                    if citizen_ids is not None and uid not in citizen_ids:
+                        continue
+                    balances.append(bal)
         return balances
         
     # ── 24時間タスク ──────────────────────────────────────
@@ -5148,8 +5309,8 @@ class ServerStats(commands.Cog):
     async def daily_log_task(self):
         try:
             balances = await self._get_citizen_balances()
-            total    = sum(balances)
-            gini     = self._calc_gini(balances)
+            # ソートと集計はイベントループ（ハートビート）を止めないよう別スレッドで行う
+            _, total, _, gini = await asyncio.to_thread(self._summarize_balances, balances)
             today    = datetime.datetime.now().strftime("%Y-%m-%d")
 
             # セスタ総量
@@ -5187,12 +5348,9 @@ class ServerStats(commands.Cog):
         try:
             # 現在の市民残高
             balances = await self._get_citizen_balances()
-            balances.sort()
-            count       = len(balances)
-            total_stell = sum(balances)
+            # ソートと集計はイベントループ（ハートビート）を止めないよう別スレッドで行う
+            count, total_stell, median, gini = await asyncio.to_thread(self._summarize_balances, balances)
             avg         = total_stell // count if count else 0
-            median      = balances[count // 2] if balances else 0
-            gini        = self._calc_gini(balances)
 
             # セスタ総量
             async with self.bot.get_db() as db:
@@ -5210,25 +5368,25 @@ class ServerStats(commands.Cog):
 
                 # 24時間の資金フロー（自然 vs 運営操作）
                 cutoff_24h = datetime.datetime.now() - datetime.timedelta(days=1)
-                natural_mint = natural_burn = op_add = op_remove = 0
-                op_add_count = op_remove_count = 0
 
-                async with db.execute(
-                    "SELECT sender_id, receiver_id, amount, type FROM transactions WHERE created_at > ?",
-                    (cutoff_24h,)
-                ) as c:
-                    async for row in c:
-                        s_id, r_id, amt, t_type = row["sender_id"], row["receiver_id"], row["amount"], row["type"]
-                        if t_type == "SYSTEM_ADD":
-                            op_add += amt
-                            op_add_count += 1
-                        elif t_type == "SYSTEM_REMOVE":
-                            op_remove += amt
-                            op_remove_count += 1
-                        elif s_id == 0:
-                            natural_mint += amt
-                        elif r_id == 0:
-                            natural_burn += amt
+                # 集計はSQLite側で行い、1行だけ受け取る（CASE は上から順に判定）
+                async with db.execute("""
+                    SELECT
+                        COALESCE(SUM(CASE WHEN type = 'SYSTEM_ADD'    THEN amount END), 0) AS op_add,
+                        COUNT(CASE WHEN type = 'SYSTEM_ADD'    THEN 1 END)                 AS op_add_count,
+                        COALESCE(SUM(CASE WHEN type = 'SYSTEM_REMOVE' THEN amount END), 0) AS op_remove,
+                        COUNT(CASE WHEN type = 'SYSTEM_REMOVE' THEN 1 END)                 AS op_remove_count,
+                        COALESCE(SUM(CASE WHEN type = 'SYSTEM_ADD' OR type = 'SYSTEM_REMOVE' THEN NULL
+                                          WHEN sender_id = 0   THEN amount END), 0)        AS natural_mint,
+                        COALESCE(SUM(CASE WHEN type = 'SYSTEM_ADD' OR type = 'SYSTEM_REMOVE' THEN NULL
+                                          WHEN sender_id = 0   THEN NULL
+                                          WHEN receiver_id = 0 THEN amount END), 0)        AS natural_burn
+                    FROM transactions WHERE created_at > ?
+                """, (cutoff_24h,)) as c:
+                    flow = await c.fetchone()
+                op_add,       op_add_count    = flow["op_add"],       flow["op_add_count"]
+                op_remove,    op_remove_count = flow["op_remove"],    flow["op_remove_count"]
+                natural_mint, natural_burn    = flow["natural_mint"], flow["natural_burn"]
 
             # ── ステータス判定 ──
             # インフレ・デフレ
@@ -5342,172 +5500,256 @@ class ServerStats(commands.Cog):
     @app_commands.describe(role="市民ロール")
     @has_permission("SUPREME_GOD")
     async def set_citizen_role(self, interaction: discord.Interaction, role: discord.Role):
-        async with self.bot.get_db() as db:
-            await db.execute(
-                "INSERT OR REPLACE INTO server_config (key, value) VALUES ('citizen_role_id', ?)",
-                (str(role.id),)
-            )
-            await db.commit()
+        await self.bot.config.set('citizen_role_id', str(role.id))
         await interaction.response.send_message(
             f"✅ 市民ロールを {role.mention} に設定しました。", ephemeral=True
         )
 
 
+# ── ショップ商品の種別表示 ──
+SHOP_TYPE_EMOJI       = {"rental": "⏳", "permanent": "♾️", "ticket": "🎟️"}
+SHOP_TYPE_LABEL_SHORT = {"rental": "30日", "permanent": "永続", "ticket": "引換券"}
+SHOP_TYPE_LABEL_LONG  = {"rental": "30日レンタル", "permanent": "買い切り（永続）", "ticket": "引換券"}
+SHOP_BUY_LABEL        = {"rental": "購入する (30日間)", "permanent": "購入する (永続)", "ticket": "購入する (引換券)"}
+
+# ── 購入ボタン ──
+# shop_buy:{shop_id}:{role_id} が custom_id の上限(100文字)に収まるよう、ショップIDの長さを抑える
+# （"shop_buy:" + ":" の10文字と、ロールID最大20桁を除いた分）
+SHOP_ID_MAX_LEN = 70
+
+class ShopBuyButton(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"shop_buy:(?P<shop_id>.+):(?P<role_id>[0-9]+)",
+):
+    """
+    購入ボタン。custom_id に「ショップID」「商品ロールID」を埋め込む（価格などは商品キャッシュから引く）。
+    setup_hook で add_dynamic_items しておけば、押下は discord.py が custom_id から直接ここへ振り分ける。
+    """
+    def __init__(self, shop_id: str, role_id: int, label=None):
+        super().__init__(discord.ui.Button(
+            label=label,
+            style=discord.ButtonStyle.green,
+            emoji="🛒",
+            custom_id=f"shop_buy:{shop_id}:{role_id}"
+        ))
+        self.shop_id = shop_id
+        self.role_id = role_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(match['shop_id'], int(match['role_id']), label=item.label)
+
+    # ── 購入ボタンが押された時の処理 ──
+    async def callback(self, interaction: discord.Interaction):
+        item = (await interaction.client.get_shop_items(self.shop_id)).get(str(self.role_id))
+        if not item:
+            return await interaction.response.send_message("❌ この商品は現在取り扱われていません。", ephemeral=True)
+        await _do_shop_purchase(interaction.client, interaction, self.shop_id, self.role_id, item)
+
+
 # ── 購入確認View ──
 class ShopPurchaseView(discord.ui.View):
-    def __init__(self, bot, role_id, price, shop_id, item_type, max_per_user):
+    """購入ボタンだけを載せる。押下は ShopBuyButton が custom_id から処理する"""
+    def __init__(self, shop_id, role_id, item_type):
         super().__init__(timeout=None)
-        self.bot = bot
-        self.role_id = role_id
-        self.price = price
-        self.shop_id = shop_id
-        self.item_type = item_type          # 'rental' / 'permanent' / 'ticket'
-        self.max_per_user = max_per_user
-
-    def _button_label(self):
-        if self.item_type == "rental":    return "購入する (30日間)"
-        if self.item_type == "permanent": return "購入する (永続)"
-        if self.item_type == "ticket":    return "購入する (引換券)"
-        return "購入する"
-
-    @discord.ui.button(style=discord.ButtonStyle.green, emoji="🛒")
-    async def buy_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        # ボタンラベルを動的に設定できないのでdeferしてから処理
-        await interaction.response.defer(ephemeral=True)
-        user = interaction.user
+        self.add_item(ShopBuyButton(shop_id, role_id, label=SHOP_BUY_LABEL.get(item_type, "購入する")))
+
+# 購入時の引き落とし（条件を満たさなければ0行更新）と、失敗理由の確認
+_SQL_SHOP_DEBIT = "UPDATE accounts SET balance = balance - ? WHERE user_id = ? AND balance >= ?"
+_SQL_SHOP_DEBIT_LIMITED = """
+    UPDATE accounts SET balance = balance - ?
+    WHERE user_id = ? AND balance >= ?
+      AND (SELECT COUNT(*) FROM ticket_inventory WHERE user_id = ? AND item_key = ? AND used_at IS NULL) < ?
+"""
+_SQL_SHOP_BUY_STATE = """
+    SELECT (SELECT COUNT(*) FROM ticket_inventory WHERE user_id = ? AND item_key = ? AND used_at IS NULL) AS cnt,
+           (SELECT balance FROM accounts WHERE user_id = ?) AS balance
+"""
+
+# 購入済み（有効な契約・買い切りの記録がある）のにロールを持っていない場合の戻り値。引き落とさずロールだけ付け直す
+SHOP_REGRANT = object()
+
+async def _shop_purchase_tx(db, user_id, shop_id, role_id, item_type, price, max_per_user, expiry_date, item_name, role_name=None):
+    """
+    購入の書き込み部分。失敗時はユーザーに返すメッセージを返す（呼び出し側でロールバック）
+    購入済みならロールの再付与だけを行うよう SHOP_REGRANT を返す
+    """
+    # ── 購入済みの確認（退出・再参加や管理者の操作でロールだけ外れた場合は、二重に請求しない） ──
+    if item_type == "rental":
+        now_str = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
+        async with db.execute(
+            "SELECT 1 FROM shop_subscriptions WHERE user_id = ? AND role_id = ? AND expiry_date >= ?",
+            (user_id, role_id, now_str)
+        ) as c:
+            if await c.fetchone():
+                return SHOP_REGRANT
+    elif item_type == "permanent":
+        async with db.execute(
+            "SELECT 1 FROM shop_permanent_purchases WHERE user_id = ? AND role_id = ?", (user_id, role_id)
+        ) as c:
+            if await c.fetchone():
+                return SHOP_REGRANT
 
-        # ── チケット枚数上限チェック ──
-        if self.item_type == "ticket" and self.max_per_user > 0:
-            async with self.bot.get_db() as db:
-                async with db.execute(
-                    "SELECT COUNT(*) as cnt FROM ticket_inventory WHERE user_id = ? AND item_key = ? AND used_at IS NULL",
-                    (user.id, self.role_id)
-                ) as c:
-                    row = await c.fetchone()
-                    if row['cnt'] >= self.max_per_user:
-                        return await interaction.followup.send(
-                            f"❌ このチケットは1人 **{self.max_per_user}枚** までしか持てません。\n（未使用チケットを先に使ってください）",
-                            ephemeral=True
-                        )
+    # ── 残高（とチケット所持上限）を満たす場合だけ引き落とす ──
+    limited = item_type == "ticket" and max_per_user > 0
+    if limited:
+        cursor = await db.execute(_SQL_SHOP_DEBIT_LIMITED, (price, user_id, price, user_id, str(role_id), max_per_user))
+    else:
+        cursor = await db.execute(_SQL_SHOP_DEBIT, (price, user_id, price))
+    if cursor.rowcount == 0:
+        # 失敗理由は1回の問い合わせでまとめて確認する
+        async with db.execute(_SQL_SHOP_BUY_STATE, (user_id, str(role_id), user_id)) as c:
+            row = await c.fetchone()
+        if limited and row['cnt'] >= max_per_user:
+            return f"❌ このチケットは1人 **{max_per_user}枚** までしか持てません。\n（未使用チケットを先に使ってください）"
+        balance = row['balance'] or 0
+        return f"❌ お金が足りません。\n(価格: {price:,} S / 所持金: {balance:,} S)"
+
+    if item_type == "rental":
+        # 有効な契約が残っている場合は更新しない（期限切れで未削除の行だけ上書き）
+        cursor = await db.execute(
+            "INSERT INTO shop_subscriptions (user_id, role_id, expiry_date) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id, role_id) DO UPDATE SET expiry_date = excluded.expiry_date "
+            "WHERE shop_subscriptions.expiry_date < ?",
+            (user_id, role_id, expiry_date.isoformat(sep=" ", timespec="seconds"), now_str)
+        )
+        if cursor.rowcount == 0:
+            return f"❌ すでに **{role_name}** を購入済みです。"
+
+    elif item_type == "permanent":
+        # 購入記録が既にあれば0行（連打で2回目の引き落としが走ってもここでロールバックされる）
+        cursor = await db.execute(
+            "INSERT INTO shop_permanent_purchases (user_id, role_id) VALUES (?, ?) ON CONFLICT(user_id, role_id) DO NOTHING",
+            (user_id, role_id)
+        )
+        if cursor.rowcount == 0:
+            return f"❌ すでに **{role_name}** を購入済みです。"
+
+    elif item_type == "ticket":
+        # チケットをインベントリに追加（商品名は shop_items から直接写す。取り下げ済みなら0行）
+        cursor = await db.execute(
+            "INSERT INTO ticket_inventory (user_id, shop_id, item_key, item_name) "
+            "SELECT ?, shop_id, role_id, COALESCE(description, ?) FROM shop_items WHERE role_id = ? AND shop_id = ?",
+            (user_id, item_name, str(role_id), shop_id)
+        )
+        if cursor.rowcount == 0:
+            return "❌ この商品は現在取り扱われていません。"
 
-        # ── ロール系: 既に持っているか確認 ──
-        if self.item_type in ("rental", "permanent"):
-            role = interaction.guild.get_role(self.role_id)
-            if not role:
-                return await interaction.followup.send("❌ この商品は現在取り扱われていません。", ephemeral=True)
-            if role in user.roles:
-                return await interaction.followup.send(
-                    f"❌ すでに **{role.name}** を持っています。",
-                    ephemeral=True
-                )
+    month_tag = current_month_tag()
+    await db.execute(
+        "INSERT INTO transactions (sender_id, receiver_id, amount, type, description, month_tag) VALUES (?, 0, ?, 'SHOP', ?, ?)",
+        (user_id, price, f"購入: Shop({shop_id}) item({role_id})", month_tag)
+    )
+    return None
 
-        # ── 残高チェック ──
-        async with self.bot.get_db() as db:
-            async with db.execute("SELECT balance FROM accounts WHERE user_id = ?", (user.id,)) as c:
-                row = await c.fetchone()
-                balance = row['balance'] if row else 0
 
-        if balance < self.price:
+async def _do_shop_purchase(bot, interaction: discord.Interaction, shop_id, role_id, item):
+    item_type = item['item_type'] or 'rental'      # 'rental' / 'permanent' / 'ticket'
+    price = item['price']
+    max_per_user = item['max_per_user'] or 0
+
+    await interaction.response.defer(ephemeral=True)
+    user = interaction.user
+
+    # ── ロール系: 既に持っているか確認 ──
+    if item_type in ("rental", "permanent"):
+        role = interaction.guild.get_role(role_id)
+        if not role:
+            return await interaction.followup.send("❌ この商品は現在取り扱われていません。", ephemeral=True)
+        # Member.get_role は所持ロールIDのソート済み配列を二分探索する（roles の線形走査を避ける）
+        if user.get_role(role.id):
             return await interaction.followup.send(
-                f"❌ お金が足りません。\n(価格: {self.price:,} S / 所持金: {balance:,} S)",
+                f"❌ すでに **{role.name}** を持っています。",
                 ephemeral=True
             )
 
-        # ── 購入処理 ──
-        month_tag = datetime.datetime.now().strftime("%Y-%m")
-        try:
-            async with self.bot.get_db() as db:
-                await db.execute(
-                    "UPDATE accounts SET balance = balance - ? WHERE user_id = ?",
-                    (self.price, user.id)
-                )
-                await db.execute(
-                    "INSERT INTO transactions (sender_id, receiver_id, amount, type, description, month_tag) VALUES (?, 0, ?, 'SHOP', ?, ?)",
-                    (user.id, self.price, f"購入: Shop({self.shop_id}) item({self.role_id})", month_tag)
-                )
-
-                if self.item_type == "rental":
-                    expiry_date = datetime.datetime.now() + datetime.timedelta(days=30)
-                    await db.execute(
-                        "INSERT OR REPLACE INTO shop_subscriptions (user_id, role_id, expiry_date) VALUES (?, ?, ?)",
-                        (user.id, self.role_id, expiry_date.strftime("%Y-%m-%d %H:%M:%S"))
-                    )
-
-                elif self.item_type == "ticket":
-                    # チケットをインベントリに追加
-                    async with db.execute(
-                        "SELECT description FROM shop_items WHERE role_id = ? AND shop_id = ?",
-                        (str(self.role_id), self.shop_id)
-                    ) as c:
-                        item_row = await c.fetchone()
-                        item_name = item_row['description'] if item_row else "チケット"
-                    await db.execute(
-                        "INSERT INTO ticket_inventory (user_id, shop_id, item_key, item_name) VALUES (?, ?, ?, ?)",
-                        (user.id, self.shop_id, str(self.role_id), item_name)
-                    )
-
+    # ── 購入処理 ──
+    # 上限・残高の確認から引き落としまでを1つの書き込みトランザクションで行う（二度押し対策）
+    # Discordへの返信やロール付与は、書き込み接続を返してから行う
+    expiry_date = datetime.datetime.now() + datetime.timedelta(days=30)
+    item_name = item['description'] or "チケット"
+    role_name = role.name if item_type in ("rental", "permanent") else None
+    try:
+        async with bot.get_writer() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            error = await _shop_purchase_tx(db, user.id, shop_id, role_id, item_type, price, max_per_user, expiry_date, item_name, role_name)
+            if error:
+                await db.rollback()
+            else:
                 await db.commit()
+    except Exception as e:
+        return await interaction.followup.send(f"❌ エラーが発生しました: {e}", ephemeral=True)
 
-        except Exception as e:
-            await db.rollback()
-            return await interaction.followup.send(f"❌ エラーが発生しました: {e}", ephemeral=True)
-
-        # ── ロール付与 ──
-        if self.item_type in ("rental", "permanent"):
-            try:
-                role = interaction.guild.get_role(self.role_id)
-                await user.add_roles(role, reason=f"ショップ購入({self.shop_id})")
-                if self.item_type == "rental":
-                    expiry_str = expiry_date.strftime('%Y/%m/%d')
-                    msg = f"🎉 **購入完了！**\n**{role.name}** を購入しました。\n有効期限: **{expiry_str}** まで\n(-{self.price:,} S)"
-                else:
-                    msg = f"🎉 **購入完了！**\n**{role.name}** を永続付与しました。\n(-{self.price:,} S)"
-                await interaction.followup.send(msg, ephemeral=True)
-            except discord.Forbidden:
-                await interaction.followup.send("⚠️ 購入処理は完了しましたが、権限不足でロールを付与できませんでした。", ephemeral=True)
-
-        elif self.item_type == "ticket":
+    if error is SHOP_REGRANT:
+        # 購入済みなので料金はかけず、外れていたロールだけ付け直す
+        try:
+            role = interaction.guild.get_role(role_id)
+            await user.add_roles(role, reason=f"ショップ購入済みロールの再付与({shop_id})")
             await interaction.followup.send(
-                f"🎟️ **チケット購入完了！**\n**{item_name}** を1枚取得しました。\n"
-                f"管理者が確認し次第、特典が付与されます。\n(-{self.price:,} S)",
+                f"🔁 **{role.name}** は購入済みのため、ロールを再付与しました。（料金はかかっていません）",
                 ephemeral=True
             )
+        except discord.Forbidden:
+            await interaction.followup.send("⚠️ 権限不足でロールを再付与できませんでした。", ephemeral=True)
+        return
+
+    if error:
+        return await interaction.followup.send(error, ephemeral=True)
+
+    # ── ロール付与 ──
+    if item_type in ("rental", "permanent"):
+        try:
+            role = interaction.guild.get_role(role_id)
+            await user.add_roles(role, reason=f"ショップ購入({shop_id})")
+            if item_type == "rental":
+                expiry_str = expiry_date.strftime('%Y/%m/%d')
+                msg = f"🎉 **購入完了！**\n**{role.name}** を購入しました。\n有効期限: **{expiry_str}** まで\n(-{price:,} S)"
+            else:
+                msg = f"🎉 **購入完了！**\n**{role.name}** を永続付与しました。\n(-{price:,} S)"
+            await interaction.followup.send(msg, ephemeral=True)
+        except discord.Forbidden:
+            await interaction.followup.send("⚠️ 購入処理は完了しましたが、権限不足でロールを付与できませんでした。", ephemeral=True)
+
+    elif item_type == "ticket":
+        await interaction.followup.send(
+            f"🎟️ **チケット購入完了！**\n**{item_name}** を1枚取得しました。\n"
+            f"管理者が確認し次第、特典が付与されます。\n(-{price:,} S)",
+            ephemeral=True
+        )
 
 
 # ── 商品選択メニュー ──
 class ShopSelect(discord.ui.Select):
-    def __init__(self, bot, items, shop_id):
+    def __init__(self, bot, items, shop_id, options=None):
         self.bot = bot
         self.shop_id = shop_id
 
-        TYPE_EMOJI = {"rental": "⏳", "permanent": "♾️", "ticket": "🎟️"}
-        TYPE_LABEL = {"rental": "30日", "permanent": "永続", "ticket": "引換券"}
+        if options is None:
+            options = self.build_options(items)
+        super().__init__(
+            placeholder="購入したい商品を選択してください...",
+            min_values=1, max_values=1,
+            options=list(options)
+        )
 
+    @staticmethod
+    def build_options(items) -> List[discord.SelectOption]:
         options = []
         for item in items:
             t = item['item_type']
             label = f"{item['name']} ({item['price']:,} S)"
-            desc = f"[{TYPE_LABEL.get(t, '?')}] {item['desc'] or '説明なし'}"
+            desc = f"[{SHOP_TYPE_LABEL_SHORT.get(t, '?')}] {item['desc'] or '説明なし'}"
             options.append(discord.SelectOption(
                 label=label[:100],
                 description=desc[:100],
                 value=str(item['role_id']),
-                emoji=TYPE_EMOJI.get(t, "🏷️")
+                emoji=SHOP_TYPE_EMOJI.get(t, "🏷️")
             ))
-        super().__init__(
-            placeholder="購入したい商品を選択してください...",
-            min_values=1, max_values=1,
-            options=options
-        )
+        return options
 
     async def callback(self, interaction: discord.Interaction):
         role_id_str = self.values[0]
-        async with self.bot.get_db() as db:
-            async with db.execute(
-                "SELECT * FROM shop_items WHERE role_id = ? AND shop_id = ?",
-                (role_id_str, self.shop_id)
-            ) as c:
-                row = await c.fetchone()
+        row = (await self.bot.get_shop_items(self.shop_id)).get(role_id_str)
 
         if not row:
             return await interaction.response.send_message("❌ 商品情報が取得できませんでした。", ephemeral=True)
@@ -5517,9 +5759,6 @@ class ShopSelect(discord.ui.Select):
         max_per_user = row['max_per_user'] or 0
         role_id = int(role_id_str)
 
-        TYPE_LABEL = {"rental": "30日レンタル", "permanent": "買い切り（永続）", "ticket": "引換券"}
-        TYPE_EMOJI = {"rental": "⏳", "permanent": "♾️", "ticket": "🎟️"}
-
         if item_type in ("rental", "permanent"):
             role = interaction.guild.get_role(role_id)
             color = role.color if role else discord.Color.gold()
@@ -5529,31 +5768,33 @@ class ShopSelect(discord.ui.Select):
             name_str = f"🎟️ {row['description'] or 'チケット'}"
 
         embed = discord.Embed(
-            title=f"🛒 購入確認 ({TYPE_LABEL.get(item_type, '?')})",
+            title=f"🛒 購入確認 ({SHOP_TYPE_LABEL_LONG.get(item_type, '?')})",
             color=color
         )
         embed.add_field(name="商品", value=name_str, inline=False)
         embed.add_field(name="価格", value=f"**{price:,} Stell**", inline=True)
-        embed.add_field(name="種別", value=f"{TYPE_EMOJI.get(item_type)} {TYPE_LABEL.get(item_type)}", inline=True)
+        embed.add_field(name="種別", value=f"{SHOP_TYPE_EMOJI.get(item_type)} {SHOP_TYPE_LABEL_LONG.get(item_type)}", inline=True)
         if item_type == "ticket" and max_per_user > 0:
             embed.add_field(name="所持上限", value=f"{max_per_user}枚まで", inline=True)
 
-        view = ShopPurchaseView(self.bot, role_id, price, self.shop_id, item_type, max_per_user)
-        # ボタンラベルをitem_typeに合わせて変更
-        view.buy_button.label = view._button_label()
+        view = ShopPurchaseView(self.shop_id, role_id, item_type)
         await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+        # 押下は ShopBuyButton が custom_id から処理するので、クリックごとのViewは保持しない
+        view.stop()
 
 
 class ShopPanelView(discord.ui.View):
-    def __init__(self, bot, items, shop_id):
+    def __init__(self, bot, items, shop_id, options=None):
         super().__init__(timeout=None)
-        self.add_item(ShopSelect(bot, items, shop_id))
+        self.add_item(ShopSelect(bot, items, shop_id, options))
 
 
 # ── Cog本体 ──
 class ShopSystem(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        # パネルの選択肢: {shop_id: (ロール名の並び, SelectOption一覧)}。ロール名の並びが変わったら作り直す
+        self._select_options_cache: Dict[str, tuple] = {}
         self.check_subscription_expiry.start()
 
     def cog_unload(self):
@@ -5561,7 +5802,7 @@ class ShopSystem(commands.Cog):
 
     @tasks.loop(hours=1)
     async def check_subscription_expiry(self):
-        now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        now_str = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
         async with self.bot.get_db() as db:
             async with db.execute(
                 "SELECT user_id, role_id FROM shop_subscriptions WHERE expiry_date < ?", (now_str,)
@@ -5571,29 +5812,61 @@ class ShopSystem(commands.Cog):
         if not expired_rows:
             return
 
-        guild = self.bot.guilds[0]
-        async with self.bot.get_db() as db:
-            for row in expired_rows:
-                member = guild.get_member(row['user_id'])
+        # ロールの剥奪とDM通知はレート制限を考えてそれぞれ同時5件まで並行で行う
+        # （DMの待ちで剥奪の枠を塞がないよう、セマフォは別にする）
+        role_sem = asyncio.Semaphore(5)
+        dm_sem = asyncio.Semaphore(5)
+
+        async def dm_expired(member, role):
+            async with dm_sem:
+                await member.send(f"⏳ **有効期限切れ**\nロール **{role.name}** の有効期限（30日）が終了しました。")
+
+        async def expire(member, role):
+            async with role_sem:
+                try:
+                    await member.remove_roles(role, reason="ショップ有効期限切れ")
+                except:
+                    return
+            await dm_expired(member, role)
+
+        # ロールが属するサーバーを特定し、キャッシュにいないメンバーをサーバーごとに集める
+        targets = []
+        missing: Dict[discord.Guild, List[int]] = {}
+        for row in expired_rows:
+            for guild in self.bot.guilds:
                 role = guild.get_role(row['role_id'])
-                if member and role and role in member.roles:
-                    try:
-                        await member.remove_roles(role, reason="ショップ有効期限切れ")
-                        try:
-                            await member.send(f"⏳ **有効期限切れ**\nロール **{role.name}** の有効期限（30日）が終了しました。")
-                        except:
-                            pass
-                    except:
-                        pass
-                await db.execute(
-                    "DELETE FROM shop_subscriptions WHERE user_id = ? AND role_id = ?",
-                    (row['user_id'], row['role_id'])
-                )
+                if role:
+                    targets.append((guild, role, row['user_id']))
+                    if guild.get_member(row['user_id']) is None:
+                        missing.setdefault(guild, []).append(row['user_id'])
+                    break
+
+        # 取りこぼしが多い時だけ、Gatewayにまとめて問い合わせてキャッシュを埋める（1回100人まで）
+        for guild, user_ids in missing.items():
+            if len(user_ids) <= 20:
+                continue
+            for i in range(0, len(user_ids), 100):
+                try:
+                    await guild.query_members(user_ids=user_ids[i:i + 100], limit=100, cache=True)
+                except Exception as e:
+                    logger.error(f"Subscription Member Query Error: {e}")
+
+        jobs = []
+        for guild, role, user_id in targets:
+            member = guild.get_member(user_id)
+            if member and member.get_role(role.id):
+                jobs.append(expire(member, role))
+        await asyncio.gather(*jobs, return_exceptions=True)
+
+        # 期限切れの行は SELECT と同じ基準時刻で一括削除する
+        async with self.bot.get_writer() as db:
+            await db.execute("DELETE FROM shop_subscriptions WHERE expiry_date < ?", (now_str,))
             await db.commit()
 
     @check_subscription_expiry.before_loop
     async def before_check(self):
         await self.bot.wait_until_ready()
+
     @app_commands.command(name="ショップ_商品登録", description="ショップに商品を登録します")
     @app_commands.rename(shop_id="ショップid", role="商品ロール", price="価格", description="説明文", item_type="種別", max_per_user="所持上限")
     @app_commands.describe(
@@ -5614,17 +5887,20 @@ class ShopSystem(commands.Cog):
         await interaction.response.defer(ephemeral=True)
         if price < 0:
             return await interaction.followup.send("❌ 価格は0以上にしてください。", ephemeral=True)
+        if len(shop_id) > SHOP_ID_MAX_LEN:
+            return await interaction.followup.send(f"❌ ショップIDは{SHOP_ID_MAX_LEN}文字以内にしてください。", ephemeral=True)
 
-        async with self.bot.get_db() as db:
+        async with self.bot.get_writer() as db:
             await db.execute(
                 "INSERT OR REPLACE INTO shop_items (role_id, shop_id, price, description, item_type, max_per_user) VALUES (?, ?, ?, ?, ?, ?)",
                 (str(role.id), shop_id, price, description, item_type, max_per_user)
             )
             await db.commit()
+        self.bot.shop_cache.pop(shop_id, None)
+        self._select_options_cache.pop(shop_id, None)
 
-        TYPE_LABEL = {"rental": "30日", "permanent": "永続", "ticket": "引換券"}
         await interaction.followup.send(
-            f"✅ ショップ(`{shop_id}`) に **{role.name}** ({price:,} S / {TYPE_LABEL.get(item_type)}) を登録しました。",
+            f"✅ ショップ(`{shop_id}`) に **{role.name}** ({price:,} S / {SHOP_TYPE_LABEL_SHORT.get(item_type)}) を登録しました。",
             ephemeral=True
         )
     @app_commands.command(name="ショップ_商品削除", description="ショップから商品を取り下げます")
@@ -5633,12 +5909,14 @@ class ShopSystem(commands.Cog):
     @has_permission("SUPREME_GOD")
     async def shop_remove(self, interaction: discord.Interaction, shop_id: str, role: discord.Role):
         await interaction.response.defer(ephemeral=True)
-        async with self.bot.get_db() as db:
+        async with self.bot.get_writer() as db:
             await db.execute(
                 "DELETE FROM shop_items WHERE role_id = ? AND shop_id = ?",
                 (str(role.id), shop_id)
             )
             await db.commit()
+        self.bot.shop_cache.pop(shop_id, None)
+        self._select_options_cache.pop(shop_id, None)
         await interaction.followup.send(f"🗑️ ショップ(`{shop_id}`) から **{role.name}** を削除しました。", ephemeral=True)
     @app_commands.command(name="ショップ_パネル設置", description="指定したIDのショップパネルを設置します")
     @app_commands.rename(shop_id="ショップid", title="タイトル", content="本文", image_url="画像url")
@@ -5647,18 +5925,12 @@ class ShopSystem(commands.Cog):
     async def shop_panel(self, interaction: discord.Interaction, shop_id: str, title: str = "🛒 ステラショップ", content: str = "欲しい商品を選択してください！", image_url: str = None):
         await interaction.response.defer()
 
-        async with self.bot.get_db() as db:
-            async with db.execute(
-                "SELECT * FROM shop_items WHERE shop_id = ?", (shop_id,)
-            ) as cursor:
-                rows = await cursor.fetchall()
+        rows = list((await self.bot.get_shop_items(shop_id)).values())
 
         if not rows:
             return await interaction.followup.send(f"❌ ショップID `{shop_id}` に商品がありません。", ephemeral=True)
 
         items = []
-        TYPE_EMOJI = {"rental": "⏳", "permanent": "♾️", "ticket": "🎟️"}
-        TYPE_LABEL = {"rental": "30日", "permanent": "永続", "ticket": "引換券"}
         item_list_text = ""
 
         for row in rows:
@@ -5675,7 +5947,7 @@ class ShopSystem(commands.Cog):
                 'max_per_user': row['max_per_user'] or 0,
             })
             limit_str = f"（上限{row['max_per_user']}枚）" if t == "ticket" and row['max_per_user'] > 0 else ""
-            item_list_text += f"{TYPE_EMOJI.get(t)} **{role.name}**: `{row['price']:,} S` [{TYPE_LABEL.get(t)}]{limit_str}\n"
+            item_list_text += f"{SHOP_TYPE_EMOJI.get(t)} **{role.name}**: `{row['price']:,} S` [{SHOP_TYPE_LABEL_SHORT.get(t)}]{limit_str}\n"
 
         if not items:
             return await interaction.followup.send("❌ 有効な商品がありません。", ephemeral=True)
@@ -5685,7 +5957,14 @@ class ShopSystem(commands.Cog):
             embed.set_image(url=image_url)
         embed.add_field(name="📦 ラインナップ", value=item_list_text, inline=False)
 
-        view = ShopPanelView(self.bot, items, shop_id)
+        token = tuple(item['name'] for item in items)
+        cached = self._select_options_cache.get(shop_id)
+        if cached and cached[0] == token:
+            options = cached[1]
+        else:
+            options = ShopSelect.build_options(items)
+            self._select_options_cache[shop_id] = (token, options)
+        view = ShopPanelView(self.bot, items, shop_id, options)
         await interaction.followup.send(embed=embed, view=view)
     @app_commands.command(name="チケット確認", description="【管理者】未使用チケットの一覧を確認します")
     @app_commands.describe(shop_id="対象のショップID（省略で全件）")
@@ -5696,13 +5975,13 @@ class ShopSystem(commands.Cog):
         async with self.bot.get_db() as db:
             if shop_id:
                 async with db.execute(
-                    "SELECT * FROM ticket_inventory WHERE used_at IS NULL AND shop_id = ? ORDER BY purchased_at ASC",
+                    "SELECT id, user_id, item_name, purchased_at FROM ticket_inventory WHERE used_at IS NULL AND shop_id = ? ORDER BY purchased_at ASC",
                     (shop_id,)
                 ) as c:
                     rows = await c.fetchall()
             else:
                 async with db.execute(
-                    "SELECT * FROM ticket_inventory WHERE used_at IS NULL ORDER BY purchased_at ASC"
+                    "SELECT id, user_id, item_name, purchased_at FROM ticket_inventory WHERE used_at IS NULL ORDER BY purchased_at ASC"
                 ) as c:
                     rows = await c.fetchall()
 
@@ -5730,9 +6009,9 @@ class ShopSystem(commands.Cog):
     async def ticket_use(self, interaction: discord.Interaction, ticket_id: int):
         await interaction.response.defer(ephemeral=True)
 
-        async with self.bot.get_db() as db:
+        async with self.bot.get_writer() as db:
             async with db.execute(
-                "SELECT * FROM ticket_inventory WHERE id = ?", (ticket_id,)
+                "SELECT user_id, item_name, used_at FROM ticket_inventory WHERE id = ?", (ticket_id,)
             ) as c:
                 row = await c.fetchone()
 
@@ -5741,7 +6020,7 @@ class ShopSystem(commands.Cog):
             if row['used_at']:
                 return await interaction.followup.send(f"❌ チケットID `{ticket_id}` は既に処理済みです。", ephemeral=True)
 
-            now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            now_str = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
             await db.execute(
                 "UPDATE ticket_inventory SET used_at = ?, used_by = ? WHERE id = ?",
                 (now_str, interaction.user.id, ticket_id)
@@ -5781,10 +6060,7 @@ class AdminTools(commands.Cog):
     @has_permission("SUPREME_GOD")
     async def config_log_channel(self, interaction: discord.Interaction, log_type: str, channel: discord.TextChannel):
         await interaction.response.defer(ephemeral=True)
-        async with self.bot.get_db() as db:
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES (?, ?)", (log_type, str(channel.id)))
-            await db.commit()
-        await self.bot.config.reload()
+        await self.bot.config.set(log_type, str(channel.id))
         await interaction.followup.send(f"✅ **{channel.mention}** をログ出力先に設定しました。", ephemeral=True)
 
     @app_commands.command(name="管理者権限設定", description="【オーナー用】管理権限ロールを登録・更新します")
@@ -5858,17 +6134,7 @@ class AdminTools(commands.Cog):
         if not message.guild:
             return
 
-        log_ch_id = None
-        async with self.bot.get_db() as db:
-            async with db.execute("SELECT value FROM server_config WHERE key = 'delete_log_id'") as c:
-                row = await c.fetchone()
-                if row:
-                    log_ch_id = int(row['value'])
-
-        if not log_ch_id:
-            return
-
-        channel = self.bot.get_channel(log_ch_id)
+        channel = self.bot.config.get_channel('delete_log_id')
         if not channel:
             return
 
@@ -5929,13 +6195,12 @@ class AdminTools(commands.Cog):
             if not members:
                 return await interaction.followup.send(f"❌ {role.mention} にメンバーがいません。", ephemeral=True)
 
+        rows = [(m.id, g, today) for m in members for g in games]
         async with self.bot.get_db() as db:
-            for m in members:
-                for g in games:
-                    await db.execute("""
-                        INSERT OR IGNORE INTO daily_play_exemptions (user_id, game, date)
-                        VALUES (?, ?, ?)
-                    """, (m.id, g, today))
+            await db.executemany("""
+                INSERT OR IGNORE INTO daily_play_exemptions (user_id, game, date)
+                VALUES (?, ?, ?)
+            """, rows)
             await db.commit()
 
         game_str = "チンチロ・ブラックジャック両方" if game == "all" else ("チンチロ" if game == "chinchiro" else "ブラックジャック")
@@ -5952,10 +6217,9 @@ class AdminTools(commands.Cog):
 
 async def _do_close_ticket(bot, interaction: discord.Interaction, ch: discord.TextChannel, ticket):
     """チケットのログ生成・DB更新・チャンネル削除を行う共通処理"""
-    import io
     guild = interaction.guild
 
-    log_lines = [
+    log_header = [
         "=== チケットログ ===",
         f"チケットID : {ch.id}",
         f"種類       : {ticket['type_name']}",
@@ -5965,17 +6229,20 @@ async def _do_close_ticket(bot, interaction: discord.Interaction, ch: discord.Te
         f"クローズ日 : {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
         "=" * 40, ""
     ]
+    # 行リスト→結合文字列→bytes と3重に持たず、読みながら1つのバッファへ直接書き込む
+    buf = io.BytesIO()
+    buf.write("\n".join(log_header).encode("utf-8"))
     async for msg in ch.history(limit=None, oldest_first=True):
         ts   = msg.created_at.strftime("%Y-%m-%d %H:%M:%S")
         name = f"{msg.author.display_name} ({msg.author.id})"
-        line = f"[{ts}] {name}: {msg.content or ''}"
+        line = f"\n[{ts}] {name}: {msg.content or ''}"
         if msg.attachments:
             line += "\n  📎 " + " ".join(a.url for a in msg.attachments)
-        log_lines.append(line)
+        buf.write(line.encode("utf-8"))
 
-    log_bytes = "\n".join(log_lines).encode("utf-8")
+    buf.seek(0)
     log_file  = discord.File(
-        fp=io.BytesIO(log_bytes),
+        fp=buf,
         filename=f"ticket_{ch.id}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
     )
 
@@ -6318,7 +6585,7 @@ class TicketSystem(commands.Cog):
         # interactionをチャンネルに差し替えて処理するため、直接処理を書く
         await interaction.response.defer(ephemeral=True)
 
-        log_lines = [
+        log_header = [
             f"=== チケットログ (強制クローズ) ===",
             f"チケットID : {channel.id}",
             f"種類       : {ticket['type_name']}",
@@ -6329,20 +6596,21 @@ class TicketSystem(commands.Cog):
             "=" * 40,
             ""
         ]
+        buf = io.BytesIO()
+        buf.write("\n".join(log_header).encode("utf-8"))
         async for message in channel.history(limit=None, oldest_first=True):
             ts      = message.created_at.strftime("%Y-%m-%d %H:%M:%S")
             name    = f"{message.author.display_name} ({message.author.id})"
             content = message.content or ""
             attachments = " ".join(a.url for a in message.attachments)
-            line = f"[{ts}] {name}: {content}"
+            line = f"\n[{ts}] {name}: {content}"
             if attachments:
                 line += f"\n  📎 {attachments}"
-            log_lines.append(line)
+            buf.write(line.encode("utf-8"))
 
-        log_text  = "\n".join(log_lines)
-        log_bytes = log_text.encode("utf-8")
+        buf.seek(0)
         log_file  = discord.File(
-            fp=__import__("io").BytesIO(log_bytes),
+            fp=buf,
             filename=f"ticket_{channel.id}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
         )
 
@@ -6373,6 +6641,16 @@ class TicketSystem(commands.Cog):
             logger.error(f"Force close delete error: {e}")
 
         await interaction.followup.send("✅ チケットを強制クローズしました。", ephemeral=True)
+# ── 面接の祝金SQL（個別評価・VC一括合格で同じ文字列を使い、接続ごとの文キャッシュに載せる） ──
+_SQL_INTERVIEW_ADD_BONUS = """
+    INSERT INTO accounts (user_id, balance, total_earned) VALUES (?, ?, 0)
+    ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
+"""
+_SQL_INTERVIEW_INSERT_TX = """
+    INSERT INTO transactions (sender_id, receiver_id, amount, type, description, month_tag)
+    VALUES (0, ?, ?, 'BONUS', ?, ?)
+"""
+
 class InterviewPanelView(discord.ui.View):
     def __init__(self, bot, routes, probation_role_id):
         super().__init__(timeout=None)
@@ -6408,7 +6686,7 @@ class InterviewPanelView(discord.ui.View):
             probation_role = interaction.guild.get_role(self.probation_role_id)
             new_role = interaction.guild.get_role(data['role_id'])
             bonus_amount = 30000
-            month_tag = datetime.datetime.now().strftime("%Y-%m")
+            month_tag = current_month_tag()
 
             try:
                 # ロールの付け替え
@@ -6419,15 +6697,8 @@ class InterviewPanelView(discord.ui.View):
 
                 # 祝金の付与
                 async with self.bot.get_db() as db:
-                    await db.execute("""
-                        INSERT INTO accounts (user_id, balance, total_earned) VALUES (?, ?, 0)
-                        ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
-                    """, (member.id, bonus_amount))
-                    
-                    await db.execute("""
-                        INSERT INTO transactions (sender_id, receiver_id, amount, type, description, month_tag)
-                        VALUES (0, ?, ?, 'BONUS', ?, ?)
-                    """, (member.id, bonus_amount, f"面接合格: {data['desc']}", month_tag))
+                    await db.execute(_SQL_INTERVIEW_ADD_BONUS, (member.id, bonus_amount))
+                    await db.execute(_SQL_INTERVIEW_INSERT_TX, (member.id, bonus_amount, f"面接合格: {data['desc']}", month_tag))
                     await db.commit()
 
                 # ログ送信
@@ -6438,15 +6709,8 @@ class InterviewPanelView(discord.ui.View):
                 embed.add_field(name="祝金", value=f"**{bonus_amount:,} Stell**", inline=False)
                 embed.set_footer(text=f"担当面接官: {interaction.user.display_name}")
 
-                log_ch_id = None
-                async with self.bot.get_db() as db:
-                    async with db.execute("SELECT value FROM server_config WHERE key = 'interview_log_id'") as c:
-                        row = await c.fetchone()
-                        if row: log_ch_id = int(row['value'])
-                
-                if log_ch_id:
-                    log_ch = self.bot.get_channel(log_ch_id)
-                    if log_ch: await log_ch.send(embed=embed)
+                log_ch = self.bot.config.get_channel('interview_log_id')
+                if log_ch: await log_ch.send(embed=embed)
 
                 await interaction.followup.send(f"✅ **{member.display_name}** を **{data['desc']}** ルートで処理し、祝金を付与しました。", ephemeral=True)
 
@@ -6457,27 +6721,80 @@ class InterviewPanelView(discord.ui.View):
         return callback
 
 # ── Cog: InterviewSystem (2段階評価システム) ──
+class EvalRouteButton(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"eval_route:(?P<user_id>[0-9]+):(?P<base_role_id>[0-9]+):(?P<new_role_id>[0-9]+)",
+):
+    """
+    2週間評価のルートボタン。
+    custom_id に「ユーザーID」「剥奪する旧ロールID」「付与する新ロールID」を埋め込む（再起動対策）。
+    setup_hook で add_dynamic_items しておけば、押下は discord.py が custom_id から直接ここへ振り分ける。
+    """
+    def __init__(self, user_id: int, base_role_id: int, new_role_id: int, label=None, emoji=None):
+        super().__init__(discord.ui.Button(
+            label=label,
+            emoji=emoji,
+            style=discord.ButtonStyle.primary,
+            custom_id=f"eval_route:{user_id}:{base_role_id}:{new_role_id}"
+        ))
+        self.target_id    = user_id
+        self.base_role_id = base_role_id
+        self.new_role_id  = new_role_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(
+            int(match['user_id']), int(match['base_role_id']), int(match['new_role_id']),
+            label=item.label, emoji=item.emoji
+        )
+
+    # ── ボタンが押された時の処理 (Phase 2: 2週間後の評価) ──
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.response.defer(ephemeral=True)
+
+        member = interaction.guild.get_member(self.target_id)
+        if not member:
+            return await interaction.followup.send("❌ ユーザーが既にサーバーにいないようです。", ephemeral=True)
+
+        base_role = interaction.guild.get_role(self.base_role_id)
+        new_role = interaction.guild.get_role(self.new_role_id)
+
+        try:
+            # ロールの付け替え (Bロールを剥奪して、C/Dロールを付与)
+            if base_role and base_role in member.roles:
+                await member.remove_roles(base_role, reason="2週間評価: Bロール剥奪")
+            if new_role:
+                await member.add_roles(new_role, reason="2週間評価: ルート確定ロール付与")
+
+            # 押したボタンのあるメッセージを更新(ボタンを消して完了済みにする)
+            completed_embed = interaction.message.embeds[0]
+            completed_embed.color = discord.Color.gold()
+            completed_embed.title = f"✅ 評価完了: {member.display_name}"
+            completed_embed.description = f"決定ルート: {new_role.mention if new_role else '不明'}\n担当: {interaction.user.display_name}"
+            
+            # ビューを空にしてメッセージを更新
+            await interaction.message.edit(embed=completed_embed, view=None)
+            await interaction.followup.send(f"✅ {member.display_name} の評価を完了し、ロールを更新しました。", ephemeral=True)
+
+        except Exception as e:
+            logger.error(f"Eval Error: {e}")
+            await interaction.followup.send("❌ ロールの変更中にエラーが発生しました。権限などを確認してください。", ephemeral=True)
+
+
 class DynamicEvalView(discord.ui.View):
     def __init__(self, user_id, base_role_id, routes):
         super().__init__(timeout=None) # タイムアウトなしで2週間後でも押せるようにする
         
         # データベースに登録されているルートの数だけボタンを生成
         for slot, data in routes.items():
-            btn = discord.ui.Button(
-                label=data['desc'],
-                emoji=data['emoji'],
-                style=discord.ButtonStyle.primary,
-                # custom_id に「ユーザーID」「剥奪する旧ロールID」「付与する新ロールID」を埋め込む（再起動対策）
-                custom_id=f"eval_route:{user_id}:{base_role_id}:{data['role_id']}"
-            )
-            self.add_item(btn)
+            self.add_item(EvalRouteButton(user_id, base_role_id, data['role_id'], label=data['desc'], emoji=data['emoji']))
 
 
 # ── Cog: RankingSystem (Probot代替) ──
 class RankingSystem(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self._xp_cooldown: Dict[int, datetime.datetime] = {}  # {user_id: last_xp_time}
+        self._xp_cooldown: Dict[int, float] = {}  # {user_id: 最後にXPを付与した time.monotonic()}
 
     @staticmethod
     def calc_level(xp: int) -> int:
@@ -6536,9 +6853,10 @@ class RankingSystem(commands.Cog):
                     (user_id, month_tag)
                 )
                 # XP加算（60秒クールダウン）
+                mono_now = time.monotonic()
                 last = self._xp_cooldown.get(user_id)
-                if not last or (now - last).total_seconds() >= 60:
-                    self._xp_cooldown[user_id] = now
+                if last is None or mono_now - last >= 60:
+                    self._xp_cooldown[user_id] = mono_now
                     xp_gain = random.randint(15, 25)
                     await db.execute(
                         "INSERT OR IGNORE INTO user_levels (user_id) VALUES (?)", (user_id,)
@@ -6569,7 +6887,7 @@ class RankingSystem(commands.Cog):
     async def rank(self, interaction: discord.Interaction):
         await interaction.response.defer()
         user = interaction.user
-        month_tag = datetime.datetime.now().strftime("%Y-%m")
+        month_tag = current_month_tag()
 
         async with self.bot.get_db() as db:
             # レベルデータ
@@ -6693,7 +7011,7 @@ class RankingSystem(commands.Cog):
     async def message_ranking(self, interaction: discord.Interaction, top: int = 10):
         await interaction.response.defer()
         top = max(1, min(top, 25))
-        month_tag = datetime.datetime.now().strftime("%Y-%m")
+        month_tag = current_month_tag()
 
         async with self.bot.get_db() as db:
             async with db.execute(
@@ -6733,20 +7051,18 @@ class InterviewSystem(commands.Cog):
     @has_permission("SUPREME_GOD")
     async def config_eval_branch(self, interaction: discord.Interaction, slot: int, role: discord.Role, emoji: str, description: str):
         await interaction.response.defer(ephemeral=True)
-        async with self.bot.get_db() as db:
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES (?, ?)", (f"branch_{slot}_role", str(role.id)))
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES (?, ?)", (f"branch_{slot}_emoji", emoji))
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES (?, ?)", (f"branch_{slot}_desc", description))
-            await db.commit()
+        await self.bot.config.set_many({
+            f"branch_{slot}_role":  str(role.id),
+            f"branch_{slot}_emoji": emoji,
+            f"branch_{slot}_desc":  description,
+        })
         await interaction.followup.send(f"✅ **ルート {slot}** を設定しました。\n{emoji} {description} ➡ {role.mention}", ephemeral=True)
 
     @app_commands.command(name="評価パネル送信先設定", description="【管理者】VC面接通過後、2週間後の評価パネルを送るチャンネルを設定します")
     @has_permission("SUPREME_GOD")
     async def config_eval_channel(self, interaction: discord.Interaction, channel: discord.TextChannel):
         await interaction.response.defer(ephemeral=True)
-        async with self.bot.get_db() as db:
-            await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES ('eval_channel_id', ?)", (str(channel.id),))
-            await db.commit()
+        await self.bot.config.set('eval_channel_id', str(channel.id))
         await interaction.followup.send(f"✅ VC面接通過後の「評価待ちパネル」を {channel.mention} に送信するよう設定しました。", ephemeral=True)
 
     # ── 2. 除外ロールの管理 (複数対応) ──
@@ -6754,44 +7070,39 @@ class InterviewSystem(commands.Cog):
     @has_permission("SUPREME_GOD")
     async def add_exclude_role(self, interaction: discord.Interaction, role: discord.Role):
         await interaction.response.defer(ephemeral=True)
-        async with self.bot.get_db() as db:
-            async with db.execute("SELECT value FROM server_config WHERE key = 'interview_exclude_roles'") as c:
-                row = await c.fetchone()
-                current = row['value'].split(',') if row and row['value'] else []
-            
-            if str(role.id) not in current:
-                current.append(str(role.id))
-                await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES ('interview_exclude_roles', ?)", (','.join(current),))
-                await db.commit()
-                await interaction.followup.send(f"✅ {role.mention} を除外ロールに追加しました。", ephemeral=True)
-            else:
-                await interaction.followup.send(f"⚠️ {role.mention} は既に除外ロールに登録されています。", ephemeral=True)
+        config = self.bot.config
+        async with config.write_lock:
+            current = config.interview_exclude_roles
+            added = role.id not in current
+            if added:
+                await config.set('interview_exclude_roles', ','.join(map(str, sorted(current | {role.id}))))
+
+        if added:
+            await interaction.followup.send(f"✅ {role.mention} を除外ロールに追加しました。", ephemeral=True)
+        else:
+            await interaction.followup.send(f"⚠️ {role.mention} は既に除外ロールに登録されています。", ephemeral=True)
 
     @app_commands.command(name="面接除外_削除", description="【管理者】登録されている除外ロールを解除します")
     @has_permission("SUPREME_GOD")
     async def remove_exclude_role(self, interaction: discord.Interaction, role: discord.Role):
         await interaction.response.defer(ephemeral=True)
-        async with self.bot.get_db() as db:
-            async with db.execute("SELECT value FROM server_config WHERE key = 'interview_exclude_roles'") as c:
-                row = await c.fetchone()
-                current = row['value'].split(',') if row and row['value'] else []
-            
-            if str(role.id) in current:
-                current.remove(str(role.id))
-                await db.execute("INSERT OR REPLACE INTO server_config (key, value) VALUES ('interview_exclude_roles', ?)", (','.join(current),))
-                await db.commit()
-                await interaction.followup.send(f"🗑️ {role.mention} を除外ロールから削除しました。", ephemeral=True)
-            else:
-                await interaction.followup.send(f"⚠️ {role.mention} は除外ロールに登録されていません。", ephemeral=True)
+        config = self.bot.config
+        async with config.write_lock:
+            current = config.interview_exclude_roles
+            removed = role.id in current
+            if removed:
+                await config.set('interview_exclude_roles', ','.join(map(str, sorted(current - {role.id}))))
+
+        if removed:
+            await interaction.followup.send(f"🗑️ {role.mention} を除外ロールから削除しました。", ephemeral=True)
+        else:
+            await interaction.followup.send(f"⚠️ {role.mention} は除外ロールに登録されていません。", ephemeral=True)
 
     @app_commands.command(name="面接除外_一覧", description="【管理者】現在登録されている除外ロールの一覧を確認します")
     @has_permission("ADMIN")
     async def list_exclude_roles(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
-        async with self.bot.get_db() as db:
-            async with db.execute("SELECT value FROM server_config WHERE key = 'interview_exclude_roles'") as c:
-                row = await c.fetchone()
-                current = row['value'].split(',') if row and row['value'] else []
+        current = sorted(self.bot.config.interview_exclude_roles)
 
         if not current:
             return await interaction.followup.send("📝 除外ロールは登録されていません。", ephemeral=True)
@@ -6812,76 +7123,82 @@ class InterviewSystem(commands.Cog):
         channel = interaction.user.voice.channel
         await interaction.response.defer(ephemeral=True)
 
-        exclude_roles = []
-        eval_channel_id = None
-        routes = {}
-
-        # DBから設定を読み込む
-        async with self.bot.get_db() as db:
-            async with db.execute("SELECT value FROM server_config WHERE key = 'interview_exclude_roles'") as c:
-                row = await c.fetchone()
-                if row and row['value']: exclude_roles = [int(x) for x in row['value'].split(',')]
-            
-            async with db.execute("SELECT value FROM server_config WHERE key = 'eval_channel_id'") as c:
-                row = await c.fetchone()
-                if row: eval_channel_id = int(row['value'])
-
-            for i in range(1, 6):
-                async with db.execute("SELECT key, value FROM server_config WHERE key LIKE ?", (f"branch_{i}_%",)) as c:
-                    rows = await c.fetchall()
-                    data = {}
-                    for r in rows:
-                        if r['key'].endswith('_role'): data['role_id'] = int(r['value'])
-                        elif r['key'].endswith('_emoji'): data['emoji'] = r['value']
-                        elif r['key'].endswith('_desc'): data['desc'] = r['value']
-                    if 'role_id' in data: routes[i] = data
+        # 設定はメモリ上の server_config から読む
+        exclude_roles = self.bot.config.interview_exclude_roles
+        eval_channel_id = self.bot.config.get_int('eval_channel_id')
+        routes = self.bot.config.get_eval_routes()
 
         processed_members = []
         bonus_amount = 30000
-        month_tag = datetime.datetime.now().strftime("%Y-%m")
-
-        # 対象者のロール付け替えと祝金付与
-        async with self.bot.get_db() as db:
-            for member in channel.members:
-                if member.bot: continue
-                if any(r.id in exclude_roles for r in member.roles): continue
-                if target_role not in member.roles: continue
-
+        month_tag = current_month_tag()
+
+        # 対象者のロール付け替え（Aロール削除とBロール付与を1回の編集で行い、同時5人まで並行）
+        sem = asyncio.Semaphore(5)
+
+        async def promote(member):
+            async with sem:
+                # edit(roles=...) は全置き換えなので、順番待ちの後・編集の直前に最新のロールから組み立てる
+                # （Bロールを既に持っていても重複させない）
+                new_roles = [
+                    r for r in member.roles
+                    if not r.is_default() and r.id not in (target_role.id, new_role.id)
+                ]
+                new_roles.append(new_role)
                 try:
+                    await member.edit(roles=new_roles, reason="面接一括合格: Aロール削除・Bロール付与")
+                except discord.HTTPException as e:
+                    # 一括編集に失敗した場合（管理外のロールを持っている等）は個別の付け外しでやり直す
+                    logger.error(f"Interview role edit failed ({member.id}), falling back: {e}")
                     await member.remove_roles(target_role, reason="面接一括合格: Aロール削除")
                     await member.add_roles(new_role, reason="面接一括合格: Bロール付与")
-                    
-                    await db.execute("""
-                        INSERT INTO accounts (user_id, balance, total_earned) VALUES (?, ?, 0)
-                        ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
-                    """, (member.id, bonus_amount))
-                    
-                    await db.execute("""
-                        INSERT INTO transactions (sender_id, receiver_id, amount, type, description, month_tag)
-                        VALUES (0, ?, ?, 'BONUS', '面接一括合格祝い', ?)
-                    """, (member.id, bonus_amount, month_tag))
-                    
-                    processed_members.append(member)
-                except Exception as e:
-                    logger.error(f"Interview Error: {e}")
-            await db.commit()
+            return member
+
+        # exclude_roles は frozenset なので、所持ロールIDとの交差判定は1回の走査で済む
+        candidates = [
+            m for m in channel.members
+            if not m.bot
+            and m.get_role(target_role.id)
+            and exclude_roles.isdisjoint(r.id for r in m.roles)
+        ]
+        results = await asyncio.gather(*(promote(m) for m in candidates), return_exceptions=True)
+        for r in results:
+            if isinstance(r, Exception):
+                logger.error(f"Interview Error: {r}")
+            else:
+                processed_members.append(r)
 
         if not processed_members:
             return await interaction.followup.send("⚠️ 対象となるメンバーがいませんでした。", ephemeral=True)
 
+        # 祝金付与（全員分を1つのトランザクションでまとめて書き込む）
+        account_rows = [(m.id, bonus_amount) for m in processed_members]
+        tx_rows = [(m.id, bonus_amount, "面接一括合格祝い", month_tag) for m in processed_members]
+        async with self.bot.get_db() as db:
+            await db.executemany(_SQL_INTERVIEW_ADD_BONUS, account_rows)
+            await db.executemany(_SQL_INTERVIEW_INSERT_TX, tx_rows)
+            await db.commit()
+
         # 実行者(自分)への結果報告（Ephemeral）
         embed = discord.Embed(title="🌸 VC面接 合格処理完了", color=Color.SUCCESS)
         embed.add_field(name="処理人数", value=f"{len(processed_members)} 名", inline=False)
         embed.add_field(name="ロール変更", value=f"{target_role.mention} ➡ {new_role.mention}", inline=False)
-        names = ", ".join([m.display_name for m in processed_members])
-        embed.add_field(name="対象者", value=names[:1000], inline=False)
+        # フィールド上限に収まる分だけ名前を積む（大人数のVCでも全員分の文字列は作らない）
+        shown, length = [], 0
+        for m in processed_members:
+            length += len(m.display_name) + 2
+            if length > 1000: break
+            shown.append(m.display_name)
+        embed.add_field(name="対象者", value=", ".join(shown) or "-", inline=False)
         await interaction.followup.send(embed=embed, ephemeral=True)
 
         # 指定チャンネルへ評価パネル(備忘録)を送信
         if eval_channel_id and routes:
             eval_ch = self.bot.get_channel(eval_channel_id)
             if eval_ch:
-                for member in processed_members:
+                # パネルの投稿は同時5件まで並行で行う（1件の失敗で他を止めない）
+                post_sem = asyncio.Semaphore(5)
+
+                async def post_panel(member):
                     view = DynamicEvalView(member.id, new_role.id, routes)
                     msg_embed = discord.Embed(
                         title=f"📋 評価待ち: {member.display_name}", 
@@ -6889,57 +7206,87 @@ class InterviewSystem(commands.Cog):
                         color=Color.DARK
                     )
                     msg_embed.set_thumbnail(url=member.display_avatar.url)
-                    await eval_ch.send(content=f"{member.mention}", embed=msg_embed, view=view)
+                    try:
+                        async with post_sem:
+                            await eval_ch.send(content=f"{member.mention}", embed=msg_embed, view=view)
+                    except discord.HTTPException as e:
+                        logger.error(f"Eval Panel Error ({member.id}): {e}")
+                    finally:
+                        # 押下は EvalRouteButton が custom_id から処理するので、View はストアに残さない
+                        view.stop()
 
+                await asyncio.gather(*(post_panel(m) for m in processed_members), return_exceptions=True)
 
-    # ── 4. ボタンが押された時の処理 (Phase 2: 2週間後の評価) ──
-    @commands.Cog.listener()
-    async def on_interaction(self, interaction: discord.Interaction):
-        # コンポーネント(ボタン)じゃなければ無視
-        if interaction.type != discord.InteractionType.component: return
-        
-        custom_id = interaction.data.get("custom_id", "")
-        # 面接の評価ボタンじゃなければ無視
-        if not custom_id.startswith("eval_route:"): return
 
-        # eval_route:{user_id}:{base_role_id}:{new_role_id} の形式で情報を抽出
-        parts = custom_id.split(":")
-        if len(parts) != 4: return
-        
-        target_id = int(parts[1])
-        base_role_id = int(parts[2])
-        new_role_id = int(parts[3])
+# ── DB接続プール ──
+class DBPool:
+    """
+    設定済みの aiosqlite 接続を使い回す。
+    空きがなければ新しく開くので待ちは発生せず（入れ子の get_db でも詰まらない）、
+    返却時に max_idle 本を超える分だけ閉じる。
+    writer() は書き込み同士をアプリ側で1本ずつ順番待ちさせる（busy_timeout のポーリング待ちを避ける）。
+    """
+    def __init__(self, db_path: str, max_idle: int = 8):
+        self.db_path  = db_path
+        self.max_idle = max_idle
+        self._idle: List[aiosqlite.Connection] = []
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        # 接続を使い回すので、sqlite3 の文キャッシュも既定(128)より多めに持たせる
+        db = await aiosqlite.connect(self.db_path, cached_statements=256)
+        db.row_factory = aiosqlite.Row
+        # 接続ごとの設定は開いた時に1回だけ（WALはDBファイル側で永続）
+        await db.execute("PRAGMA foreign_keys = ON")
+        await db.execute("PRAGMA busy_timeout = 5000")
+        await db.execute("PRAGMA synchronous = NORMAL")
+        await db.execute("PRAGMA temp_store = MEMORY")
+        await db.execute("PRAGMA cache_size = -20000")
+        return db
 
-        await interaction.response.defer(ephemeral=True)
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        db = self._idle.pop() if self._idle else await self._connect()
+        try:
+            yield db
+        finally:
+            await self._release(db)
 
-        member = interaction.guild.get_member(target_id)
-        if not member:
-            return await interaction.followup.send("❌ ユーザーが既にサーバーにいないようです。", ephemeral=True)
+    async def warm(self, count: int = 3):
+        # 起動直後の最初のコマンド群が接続・PRAGMA のコストを払わないよう、先に開いておく
+        while len(self._idle) < min(count, self.max_idle):
+            self._idle.append(await self._connect())
 
-        base_role = interaction.guild.get_role(base_role_id)
-        new_role = interaction.guild.get_role(new_role_id)
+    @contextlib.asynccontextmanager
+    async def writer(self):
+        # 中で writer() を入れ子にしないこと（同じロックを待って止まる）
+        async with self._write_lock:
+            async with self.acquire() as db:
+                yield db
 
+    async def _release(self, db: aiosqlite.Connection):
         try:
-            # ロールの付け替え (Bロールを剥奪して、C/Dロールを付与)
-            if base_role and base_role in member.roles:
-                await member.remove_roles(base_role, reason="2週間評価: Bロール剥奪")
-            if new_role:
-                await member.add_roles(new_role, reason="2週間評価: ルート確定ロール付与")
-
-            # 押したボタンのあるメッセージを更新(ボタンを消して完了済みにする)
-            completed_embed = interaction.message.embeds[0]
-            completed_embed.color = discord.Color.gold()
-            completed_embed.title = f"✅ 評価完了: {member.display_name}"
-            completed_embed.description = f"決定ルート: {new_role.mention if new_role else '不明'}\n担当: {interaction.user.display_name}"
-            
-            # ビューを空にしてメッセージを更新
-            await interaction.message.edit(embed=completed_embed, view=None)
-            await interaction.followup.send(f"✅ {member.display_name} の評価を完了し、ロールを更新しました。", ephemeral=True)
-
+            # commit されずに戻ってきた書き込みは、従来どおり接続を閉じた時と同じく破棄する
+            if db.in_transaction:
+                await db.rollback()
         except Exception as e:
-            logger.error(f"Eval Error: {e}")
-            await interaction.followup.send("❌ ロールの変更中にエラーが発生しました。権限などを確認してください。", ephemeral=True)
+            logger.error(f"DB Pool Release Error: {e}")
+            await db.close()
+            return
+        if len(self._idle) < self.max_idle:
+            self._idle.append(db)
+        else:
+            await db.close()
 
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for db in idle:
+            await db.close()
+
+# 日次バックアップ（backup_YYYYMMDD.db を最新3世代だけ残す）
+BACKUP_NAME_FORMAT = "backup_{:%Y%m%d}.db"
+BACKUP_GLOB = "backup_*.db"
+BACKUP_KEEP = 3
 
 # ── Bot 本体 ──
 class CestaBankBot(commands.Bot):
@@ -6957,17 +7304,36 @@ class CestaBankBot(commands.Bot):
         
         self.db_path = "stella_bank_v1.db"
         self.db_manager = BankDatabase(self.db_path)
+        self.db_pool = DBPool(self.db_path)
         self.config = ConfigManager(self)
+        # ショップの商品一覧: {shop_id: {role_id(文字列): 商品行}}。登録・削除時に破棄する
+        self.shop_cache: Dict[str, Dict[str, dict]] = {}
+
+    async def get_shop_items(self, shop_id: str) -> Dict[str, dict]:
+        items = self.shop_cache.get(shop_id)
+        if items is None:
+            async with self.get_db() as db:
+                async with db.execute("SELECT role_id, price, description, item_type, max_per_user FROM shop_items WHERE shop_id = ?", (shop_id,)) as c:
+                    items = {str(row['role_id']): dict(row) async for row in c}
+            self.shop_cache[shop_id] = items
+        return items
 
     @contextlib.asynccontextmanager
     async def get_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            await db.execute("PRAGMA foreign_keys = ON")
-            await db.execute("PRAGMA busy_timeout = 5000")
+        async with self.db_pool.acquire() as db:
             yield db
 
+    @contextlib.asynccontextmanager
+    async def get_writer(self):
+        async with self.db_pool.writer() as db:
+            yield db
+
+    async def close(self):
+        await super().close()
+        await self.db_pool.close()
+
     async def setup_hook(self):
+        await self.db_pool.warm()
         async with self.get_db() as db:
             await self.db_manager.setup(db)
             # ジャックポット用
@@ -6999,6 +7365,10 @@ class CestaBankBot(commands.Bot):
         if types:
             self.add_view(TicketPanelView([dict(t) for t in types]))
         self.add_view(TicketControlView())
+        # 面接の2週間評価ボタン（custom_id のテンプレートで振り分け）
+        self.add_dynamic_items(EvalRouteButton)
+        # ショップの購入ボタン
+        self.add_dynamic_items(ShopBuyButton)
         
         await self.add_cog(Economy(self))
         await self.add_cog(Salary(self))
@@ -7033,39 +7403,41 @@ class CestaBankBot(commands.Bot):
         指定されたキー（currency_log_id, salary_log_id 等）の設定を読み込み、
         対応するチャンネルへログを送信します。
         """
-        async with self.get_db() as db:
-            async with db.execute("SELECT value FROM server_config WHERE key = ?", (log_key,)) as c:
-                row = await c.fetchone()
-                if row:
-                    try:
-                        channel_id = int(row['value'])
-                        channel = self.get_channel(channel_id) or await self.fetch_channel(channel_id)
-                        if channel:
-                            await channel.send(embed=embed)
-                    except Exception as e:
-                        logger.error(f"Log Send Error ({log_key}): {e}")
+        value = self.config.get(log_key)
+        if value:
+            try:
+                channel = self.config.get_channel(log_key) or await self.fetch_channel(int(value))
+                if channel:
+                    await channel.send(embed=embed)
+            except Exception as e:
+                logger.error(f"Log Send Error ({log_key}): {e}")
 
     @tasks.loop(hours=24)
     async def backup_db_task(self):
 
         # 1. 新しいバックアップを作成
-        backup_name = f"backup_{datetime.datetime.now().strftime('%Y%m%d')}.db"
+        backup_name = BACKUP_NAME_FORMAT.format(datetime.datetime.now())
         try:
-            async with self.get_db() as db:
+            # 全ページを読む処理なので、プールの接続（温まったページキャッシュ）は使わず専用の接続で行う
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute("PRAGMA busy_timeout = 5000")
+                # WALの中身を本体へ書き戻して -wal ファイルを切り詰めてから複製する
+                await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
                 await db.execute(f"VACUUM INTO '{backup_name}'")
             
             logger.info(f"Auto Backup Success: {backup_name}")
 
             # 2. 古いバックアップを削除 (最新3世代のみ残す)
             # "backup_*.db" に一致するファイルをすべて取得して、名前順(日付順)に並べる
-            backups = sorted(glob.glob("backup_*.db"))
+            # ファイル走査・削除はディスクが遅い場合に備えてイベントループの外で行う
+            backups = sorted(await asyncio.to_thread(glob.glob, BACKUP_GLOB))
             
             # バックアップが3つより多い場合、古いものから削除する
-            if len(backups) > 3:
+            if len(backups) > BACKUP_KEEP:
                 # リストの「後ろから3つ」を除いたもの（＝古いファイル）を対象にループ
-                for old_bk in backups[:-3]:
+                for old_bk in backups[:-BACKUP_KEEP]:
                     try:
-                        os.remove(old_bk) # ファイル削除
+                        await asyncio.to_thread(os.remove, old_bk) # ファイル削除
                         logger.info(f"Deleted old backup: {old_bk}")
                     except Exception as e:
                         logger.error(f"Failed to delete {old_bk}: {e}")
@@ -7073,6 +7445,9 @@ class CestaBankBot(commands.Bot):
         except Exception as e:
             logger.error(f"Backup Failure: {e}")
 
+    async def on_guild_channel_delete(self, channel):
+        self.config.forget_channel(channel.id)
+
     async def on_ready(self):
         logger.info(f"Logged in as {self.user} (ID: {self.user.id})")
         logger.info("--- Stella Bank System Online ---")